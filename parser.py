@@ -6,9 +6,161 @@
 
 import os
 import sys
+import gc
+import re
+import bz2
+import gzip
 import json
+import lzma
+import mmap
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import time
+import warnings
+import queue
+import operator
+import itertools
+import threading
+import contextlib
+import collections
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# pyarrow is optional; without it the parse cache is switched off
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# number of bytes the line scanner pulls out of the memory map at once
+SCAN_BLOCK_SIZE = 16 * 1024 * 1024
+
+# bytes of the json export per task of the parallel mode; with at most two 
+# tasks per worker in flight, this bounds the results held in memory
+RANGE_BYTES = 64 * 1024 * 1024
+
+# the only ticket fields the reports export; everything else is dropped
+# while the json is parsed
+REPORT_FIELDS = ["id", "comments"]
+
+# the columns of the flattened_emails output: one row per comment, with its 
+# position in the ticket's thread
+FLATTENED_FIELDS = ["id", "comment_index", "comments"]
+
+# comment keys whose values are timestamps, parsed to datetimes in 
+# get_comment_table (zendesk names them like "created_at")
+TIMESTAMP_SUFFIX = "_at"
+
+# compressed file extensions the loaders accept, with the function that opens
+# each of them; e.g. "export.json.gz" is treated as a json file
+COMPRESSED_OPENERS = {"gz": gzip.open, "bz2": bz2.open, "xz": lzma.open}
+
+# how many decompressed blocks the decompression thread may read ahead
+DECOMPRESS_QUEUE_SIZE = 4
+
+# directory holding the cache of parsed json exports and lookup csvs
+CACHE_DIR = "data/parser_cache"
+
+# the least recently used cache files are deleted once the cache is bigger
+CACHE_LIMIT = 20 * 1024 ** 3
+
+# bytes read from each end of a file for its content hash
+FINGERPRINT_SAMPLE = 1024 * 1024
+
+# layout of the sidecar line index, one row per line of a json export
+LINE_INDEX_DTYPE = np.dtype([("id", "<i8"), ("offset", "<i8"), 
+                             ("length", "<i8")])
+
+# directory for the per-chunk results of checkpointed report runs
+SPILL_DIR = "data/parser_spill"
+
+# records how far incrementalCustomerReport got in each input file
+STATE_FILE = "data/parser_state.json"
+
+# "Customer [list]" is a multi-select field; a ticket with several customers
+# lists them separated by this
+CUSTOMER_SEPARATOR = ","
+
+# per-customer outputs of multiCustomerReport go to subfolders of this
+PARTITION_DIR = "data/parser_output"
+
+# scratch directory for the buckets of partitionedJoinReport
+JOIN_DIR = "data/parser_join"
+
+# rows of the lookup csvs read at a time while they are partitioned
+LOOKUP_CHUNK_ROWS = 500000
+
+# on-disk index of the newest version of every ticket across exports
+DEDUP_DB = "data/parser_dedup.sqlite"
+
+# matches an "id" key with an integer value in a raw json line
+ID_PATTERN = re.compile(rb'"id"\s*:\s*(-?\d+)')
+
+# matches an "updated_at" key with a string value in a raw json line
+UPDATED_AT_PATTERN = re.compile(rb'"updated_at"\s*:\s*"([^"]*)"')
+
+# matches a json string or a bracket in a raw json line; nothing between 
+# them (numbers, literals, commas, colons) changes how deep the line nests
+JSON_TOKEN_PATTERN = re.compile(rb'"(?:[^"\\]|\\.)*"|[{}\[\]]')
+
+#######################
+#### JSON Backends ####
+#######################
+
+# environment variable that overrides the json backend picked at startup,
+# e.g. JSON_UNPACK_BACKEND=json to force the standard library
+JSON_BACKEND_ENV = "JSON_UNPACK_BACKEND"
+
+# encodes the values the json codecs don't know natively (timestamps, numpy
+# scalars) the way pandas would hand them to an analyst
+def json_default(obj):
+    if (isinstance(obj, np.generic)):
+        return obj.item()
+    if (hasattr(obj, "isoformat")):
+        return obj.isoformat()
+    raise TypeError(f"{type(obj).__name__} is not json serializable")
+
+# returns {name: (loads, dumps)} for every installed json codec, fastest 
+# first. dumps always returns a str and never escapes non-ascii characters.
+def get_json_backends():
+    backends = {}
+    try:
+        import orjson
+        backends["orjson"] = (orjson.loads, lambda obj: orjson.dumps(
+            obj, default = json_default, 
+            option = orjson.OPT_SERIALIZE_NUMPY).decode("utf8"))
+    except ImportError:
+        pass
+    try:
+        import ujson
+        backends["ujson"] = (ujson.loads, lambda obj: ujson.dumps(
+            obj, ensure_ascii = False, default = json_default))
+    except ImportError:
+        pass
+    backends["json"] = (json.loads, lambda obj: json.dumps(
+        obj, ensure_ascii = False, default = json_default))
+    return backends
+
+# picks the codec every decode and encode in this file goes through
+# name - backend name; defaults to $JSON_UNPACK_BACKEND, then to the fastest
+# installed backend
+def set_json_backend(name = None):
+    global JSON_BACKEND, json_loads, json_dumps
+    backends = get_json_backends()
+    if (name is None):
+        name = os.environ.get(JSON_BACKEND_ENV, "")
+    if (name == ""):
+        name = next(iter(backends))
+    assert name in backends, f"json backend '{name}' is not installed"
+    JSON_BACKEND = name
+    json_loads, json_dumps = backends[name]
+
+set_json_backend()
 
 ###########################
 #### Utility Functions ####
@@ -22,27 +174,344 @@ def which(lst, condition = True):
             idx.append(i)
     return idx
 
+# True if the file extension is one of COMPRESSED_OPENERS
+def is_compressed(filepath):
+    return filepath.split(".")[-1] in COMPRESSED_OPENERS
+
+# returns the extension of a file name, looking through a compression 
+# extension: "export.json.gz" -> "json"
+def get_extension(file):
+    # use -1 instead of 1 in case the user uses periods in their
+    # file name
+    parts = file.split(".")
+    if (len(parts) > 2 and is_compressed(file)):
+        return parts[-2]
+    return parts[-1]
+
 # dirpath - the path to the parser input directory
 def get_extensions(dirpath = "data/parser_input"):
     files = os.listdir(dirpath)
     extensions = []
     for file in files:
-        # use -1 instead of 1 in case the user uses periods in their
-        # file name
-        extensions.append(file.split(".")[-1])
+        extensions.append(get_extension(file))
     return extensions
 
 # given a filepath, loads that file as a json into a pandas df
-def load_json(filepath):
-    return pd.read_json(filepath, lines = True)
+# fields, comment_fields - optional projection, see project_ticket
+# cache - read the parsed df from the parse cache, writing it there first if
+# it isn't cached yet (needs pyarrow)
+def load_json(filepath, fields = None, comment_fields = None, cache = False):
+    if (cache and pa is not None):
+        frames = list(load_json_stream(filepath, 1 << 20, fields = fields,
+                                       comment_fields = comment_fields,
+                                       cache = True))
+        if (len(frames) == 0):
+            return pd.DataFrame(columns = fields)
+        return pd.concat(frames, ignore_index = True)
+    lines = itertools.chain.from_iterable(iter_line_blocks(filepath))
+    return parse_json_lines(lines, fields, comment_fields)
 
 def load_csv(filepath):
     return pd.read_csv(filepath)
 
-# returns a JsonReader object for iteration
+# reads a compressed file block by block and puts the decompressed blocks on
+# queue q, ending with an empty block (or the exception that stopped it)
+# runs in its own thread; the codecs release the GIL while they decompress, 
+# so decompression overlaps with the parsing done by the reading thread
+# stop - threading.Event set by the reader when it no longer wants blocks
+def decompress_to_queue(filepath, q, stop, block_size):
+    try:
+        with COMPRESSED_OPENERS[filepath.split(".")[-1]](filepath, "rb") as file:
+            block = file.read(block_size)
+            while block and not stop.is_set():
+                put_unless_stopped(q, block, stop)
+                block = file.read(block_size)
+        put_unless_stopped(q, b"", stop)
+    except Exception as err:
+        put_unless_stopped(q, err, stop)
+
+# q.put that gives up once stop is set, so an abandoned reader can't leave
+# the decompression thread blocked on a full queue
+def put_unless_stopped(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout = 0.1)
+            return
+        except queue.Full:
+            pass
+
+# yields the decompressed contents of a compressed file in blocks, 
+# decompressing in a background thread
+def iter_decompressed_blocks(filepath, block_size = SCAN_BLOCK_SIZE):
+    q = queue.Queue(maxsize = DECOMPRESS_QUEUE_SIZE)
+    stop = threading.Event()
+    thread = threading.Thread(target = decompress_to_queue, 
+                              args = (filepath, q, stop, block_size),
+                              daemon = True)
+    thread.start()
+    try:
+        block = q.get()
+        while not isinstance(block, Exception) and block:
+            yield block
+            block = q.get()
+        if (isinstance(block, Exception)):
+            raise block
+    finally:
+        stop.set()
+
+# splits a block of whole lines into a list of lines, dropping blank lines
+def split_lines(block):
+    return [line for line in block.split(b"\n") 
+            if line and not line.isspace()]
+
+# iter_line_blocks for compressed files: lines are cut out of the 
+# decompressed stream, carrying any partial line over to the next block
+def iter_compressed_line_blocks(filepath, block_size = SCAN_BLOCK_SIZE):
+    rest = b""
+    for block in iter_decompressed_blocks(filepath, block_size):
+        block = rest + block
+        cut = block.rfind(b"\n")
+        if (cut == -1): # no complete line in this block yet
+            rest = block
+            continue
+        rest = block[(cut + 1):]
+        yield split_lines(block[:cut])
+    if rest:
+        yield split_lines(rest)
+
+# memory maps a json line separated file and yields lists of raw lines (bytes)
+# the file is cut at the last newline of each block of block_size bytes, so
+# lines never straddle two blocks. Blank lines are dropped.
+# Compressed files (see COMPRESSED_OPENERS) are decompressed while streaming
+# start, end - optional byte range of the file to scan (uncompressed only)
+def iter_line_blocks(filepath, start = 0, end = None, 
+                     block_size = SCAN_BLOCK_SIZE):
+    if (is_compressed(filepath)):
+        assert start == 0 and end is None, "can't seek in a compressed file"
+        yield from iter_compressed_line_blocks(filepath, block_size)
+        return
+    with open(filepath, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        end = size if end is None else min(end, size)
+        if start >= end: # mmap refuses to map empty files
+            return
+        with mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+            pos = start
+            while pos < end:
+                stop = min(pos + block_size, end)
+                if stop < end:
+                    cut = mm.rfind(b"\n", pos, stop)
+                    if cut == -1: # one line is longer than the whole block
+                        cut = mm.find(b"\n", stop, end)
+                    stop = end if cut == -1 else cut + 1
+                yield split_lines(mm[pos:stop])
+                pos = stop
+
+# pulls the top level ticket id out of a raw json line without decoding it
+# the first "id" match is only trusted when no nested object has been opened
+# before it; otherwise the line is decoded the slow way
+def scan_line_id(line):
+    match = ID_PATTERN.search(line)
+    if match is None or line.count(b"{", 0, match.start()) != 1:
+        return json_loads(line).get("id")
+    return int(match.group(1))
+
+# finds pattern at a key of the outermost object of a raw json line. The 
+# strings and brackets of the line are walked in order, keeping track of how
+# deeply they are nested, and pattern is only tried at the strings directly 
+# inside the outermost object. Returns the match, or None if there is none.
+def match_top_level(pattern, line):
+    depth = 0
+    for token in JSON_TOKEN_PATTERN.finditer(line):
+        first = line[token.start()]
+        if (first == ord('"')):
+            if (depth == 1):
+                match = pattern.match(line, token.start())
+                if (match is not None):
+                    return match
+        elif (first == ord("{") or first == ord("[")):
+            depth += 1
+        else:
+            depth -= 1
+    return None
+
+# scan_line_id for the top level "updated_at" timestamp (a string). Zendesk 
+# puts nested objects like "via" before it, so the key is found with 
+# match_top_level rather than by counting braces; a line it isn't found in 
+# is decoded the slow way
+def scan_line_updated_at(line):
+    match = match_top_level(UPDATED_AT_PATTERN, line)
+    if match is None:
+        return json_loads(line).get("updated_at")
+    return match.group(1).decode("utf8")
+
+# keeps only the raw lines whose ticket id is in the set ids
+def filter_lines_by_id(lines, ids):
+    return [line for line in lines if scan_line_id(line) in ids]
+
+# yields batches of n raw (undecoded) lines from a json line separated file
+# n - chunksize; the number of lines we want in each batch
+# ids - optional set of ticket ids; lines with other ids are dropped before 
+# they are batched, so they are never decoded
+def scan_json_lines(filepath, n, start = 0, end = None, ids = None):
+    batch = []
+    for lines in iter_line_blocks(filepath, start, end):
+        if ids is not None:
+            lines = filter_lines_by_id(lines, ids)
+        batch.extend(lines)
+        if len(batch) >= n:
+            full = len(batch) - len(batch) % n
+            for i in range(0, full, n):
+                yield batch[i:(i + n)]
+            batch = batch[full:]
+    if batch:
+        yield batch
+
+# cuts a decoded ticket down to the requested keys
+# fields - list of top level keys to keep, or None to keep all of them
+# comment_fields - list of keys to keep in each comment dictionary, or None
+# to keep all of them
+def project_ticket(ticket, fields = None, comment_fields = None):
+    if (fields is not None):
+        ticket = {key: ticket[key] for key in fields if key in ticket}
+    if (comment_fields is not None and "comments" in ticket):
+        ticket["comments"] = [{key: comment[key] for key in comment_fields 
+                               if key in comment}
+                              for comment in ticket["comments"]]
+    return ticket
+
+# decodes a batch of raw json lines into a pandas df
+# fields, comment_fields - optional projection, see project_ticket. Each line
+# is projected right after it is decoded, so dropped fields never reach the df
+def parse_json_lines(lines, fields = None, comment_fields = None):
+    if (fields is None and comment_fields is None):
+        return pd.DataFrame([json_loads(line) for line in lines])
+    records = [project_ticket(json_loads(line), fields, comment_fields) 
+               for line in lines]
+    return pd.DataFrame(records, columns = fields)
+
+# returns a generator of pandas dfs for iteration
+# lines are scanned straight out of the file and only decoded one chunk at a
+# time, as the chunk is requested
 # n - chunksize; the number of rows we want in each chunk
-def load_json_stream(filepath, n):
-    return pd.read_json(filepath, lines = True, chunksize = n)
+# start, end - optional byte range of the file to read, see split_byte_ranges
+# ids - optional set of ticket ids to keep, see scan_json_lines
+# fields, comment_fields - optional projection, see project_ticket
+# cache - read the whole file from the parse cache, parsing every line and 
+# writing the cache first if it isn't cached yet (needs pyarrow)
+def load_json_stream(filepath, n, start = 0, end = None, ids = None,
+                     fields = None, comment_fields = None, cache = False):
+    if (cache and pa is not None and start == 0 and end is None):
+        key = get_cache_key(filepath, fields, comment_fields)
+        entry = get_cache_entry(key)
+        if (entry is not None):
+            yield from read_json_cache(key, entry, n, ids)
+            return
+        frames = write_json_cache(load_json_stream(
+            filepath, n, fields = fields, comment_fields = comment_fields),
+            key, filepath)
+        for data in frames:
+            yield data if ids is None else data[data.id.isin(ids)]
+        return
+    for lines in scan_json_lines(filepath, n, start, end, ids):
+        yield parse_json_lines(lines, fields, comment_fields)
+
+# rough in-memory size of a python object, following dicts, lists and tuples
+def deep_sizeof(obj):
+    size = sys.getsizeof(obj)
+    if (isinstance(obj, dict)):
+        size += sum(deep_sizeof(k) + deep_sizeof(v) for k, v in obj.items())
+    elif (isinstance(obj, (list, tuple))):
+        size += sum(deep_sizeof(x) for x in obj)
+    return size
+
+# estimates the memory a df takes, including the dicts and lists nested in 
+# its object columns (which pandas' memory_usage doesn't follow). Object 
+# columns are measured on a sample of rows and scaled up.
+# sample - number of rows measured per object column
+def estimate_frame_bytes(data, sample = 64):
+    size = int(data.memory_usage(index = True, deep = False).sum())
+    if (len(data) == 0):
+        return size
+    rows = np.linspace(0, len(data) - 1, min(sample, len(data))).astype(int)
+    for col in data.columns:
+        if (data[col].dtype == object):
+            values = data[col].iloc[rows]
+            mean = sum(deep_sizeof(x) for x in values) / len(values)
+            size += int(mean * len(data))
+    return size
+
+# load_json_stream with chunks sized by memory instead of a row count
+# lines are collected until their raw size times the decoded/raw size ratio
+# measured on the previous chunks reaches budget bytes, so chunks of long 
+# threads get fewer rows
+# budget - target in-memory size of each df, in bytes
+# stats - optional dict that collects "rows" (rows per chunk), "bytes" 
+# (raw bytes per chunk), "decoded" (estimated df bytes per chunk) and the 
+# current "ratio"
+# ratio - initial guess of decoded size / raw size
+def load_json_stream_budgeted(filepath, budget, start = 0, end = None, 
+                              ids = None, fields = None, 
+                              comment_fields = None, stats = None, 
+                              ratio = 4.0):
+    stats = {} if stats is None else stats
+    for key in ["rows", "bytes", "decoded"]:
+        stats.setdefault(key, [])
+    stats["ratio"] = ratio
+    batch = []
+    size = 0
+    for lines in iter_line_blocks(filepath, start, end):
+        if ids is not None:
+            lines = filter_lines_by_id(lines, ids)
+        for line in lines:
+            batch.append(line)
+            size += len(line)
+            if (size * stats["ratio"] >= budget):
+                yield parse_budgeted_batch(batch, size, stats, fields, 
+                                           comment_fields)
+                batch = []
+                size = 0
+    if batch:
+        yield parse_budgeted_batch(batch, size, stats, fields, comment_fields)
+
+# decodes one chunk of load_json_stream_budgeted and updates its stats; the
+# ratio is a running average so one odd chunk doesn't swing the next one
+def parse_budgeted_batch(batch, size, stats, fields, comment_fields):
+    data = parse_json_lines(batch, fields, comment_fields)
+    decoded = estimate_frame_bytes(data)
+    stats["rows"].append(len(batch))
+    stats["bytes"].append(size)
+    stats["decoded"].append(decoded)
+    stats["ratio"] = (stats["ratio"] + decoded / max(size, 1)) / 2
+    return data
+
+# cuts a file into (start, end) byte ranges of roughly equal size
+# every boundary is moved forward to the start of the next line, so each 
+# range holds whole lines only and the ranges cover the file in order
+# shards - the number of ranges we want
+def split_byte_ranges(filepath, shards):
+    size = os.path.getsize(filepath)
+    bounds = [0]
+    with open(filepath, "rb") as file:
+        for i in range(1, shards):
+            file.seek(max(size * i // shards, bounds[-1]))
+            file.readline() # skip ahead to the end of the current line
+            bounds.append(min(file.tell(), size))
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if b > a]
+
+# pool.map that yields the results in order while keeping at most window 
+# tasks submitted and not yet yielded, so finished results don't pile up 
+# behind a slow task
+# args - iterable of argument tuples for fxn
+def iter_pool_results(pool, fxn, args, window):
+    pending = collections.deque()
+    for arg in args:
+        if (len(pending) >= window):
+            yield pending.popleft().result()
+        pending.append(pool.submit(fxn, *arg))
+    while pending:
+        yield pending.popleft().result()
 
 # dirpath - path to a directory
 # extension_type - "json" or "csv" (string)
@@ -53,26 +522,125 @@ def get_filepath_by_type(dirpath, extension_type, n = 0):
     idx = which(extensions, extension_type)
     return dirpath + "/" + files[idx[n]]
 
+# returns every file of a type in a directory, sorted by name
+# extension_type - "json" or "csv" (string)
+def get_filepaths_by_type(dirpath, extension_type):
+    extensions = get_extensions(dirpath)
+    files = os.listdir(dirpath)
+    idx = which(extensions, extension_type)
+    return sorted(dirpath + "/" + files[i] for i in idx)
+
+# file name without its directory and extensions, used to tag outputs
+# "data/parser_input/full zendesk 042020.json.gz" -> "full zendesk 042020"
+def get_file_stem(filepath):
+    name = os.path.basename(filepath)
+    if (is_compressed(name)):
+        name = name[:name.rindex(".")]
+    return name[:name.rindex(".")] if "." in name else name
+
 # gets the first .json file in the input directory
-def load_first_json(dirpath = "data/parser_input"):
-    return load_json(get_filepath_by_type(dirpath, "json", 0))
+def load_first_json(dirpath = "data/parser_input", fields = None, 
+                    comment_fields = None, cache = False):
+    return load_json(get_filepath_by_type(dirpath, "json", 0), fields, 
+                     comment_fields, cache)
 
 # returns the first .csv file in the input directory
 def load_first_csv(dirpath = "data/parser_input"):
     return load_csv(get_filepath_by_type(dirpath, "csv", 0))
 
+# loads the id -> customer lookup of a zendesk csv export: only the "Id" and
+# "Customer [list]" columns are parsed, as int64 "id" and categorical 
+# "customer". The result is cached in CACHE_DIR as a pickle keyed on the csv
+# fingerprint, so an unchanged csv loads without being parsed again.
+def load_lookup(filepath):
+    source = hashlib.sha256(os.path.abspath(filepath).encode("utf8"))
+    prefix = "lookup_" + source.hexdigest()[:16] + "_"
+    target = os.path.join(CACHE_DIR, prefix + 
+                          get_file_fingerprint(filepath)[:16] + ".pkl")
+    if (os.path.exists(target)):
+        return pd.read_pickle(target)
+    lookup = pd.read_csv(filepath, usecols = ["Id", "Customer [list]"],
+                         dtype = {"Id": "int64", 
+                                  "Customer [list]": "category"})
+    lookup = lookup.rename(columns = {"Id": "id", 
+                                      "Customer [list]": "customer"})
+    lookup = get_columns(lookup, ["id", "customer"])
+    os.makedirs(CACHE_DIR, exist_ok = True)
+    for f in os.listdir(CACHE_DIR): # older versions of the same csv
+        if (f.startswith(prefix)):
+            os.remove(os.path.join(CACHE_DIR, f))
+    lookup.to_pickle(target)
+    return lookup
+
+# load_lookup of the first .csv file in the input directory
+def load_first_lookup(dirpath = "data/parser_input"):
+    return load_lookup(get_filepath_by_type(dirpath, "csv", 0))
+
+# loads every .csv file in the input directory into one id -> customer 
+# lookup with "id" and "customer" columns. Ids that appear in several files
+# keep the customer of the last file (by name).
+def load_all_csvs(dirpath = "data/parser_input"):
+    lookups = [load_lookup(f) for f in get_filepaths_by_type(dirpath, "csv")]
+    lookup = pd.concat(lookups, ignore_index = True)
+    lookup = lookup.drop_duplicates(subset = "id", keep = "last", 
+                                    ignore_index = True)
+    # concat falls back to object when the files' categories differ
+    return lookup.astype({"customer": "category"})
+
 # ASSUMPTION: directory has no directories
 def clear_dir(dir):
     for f in os.listdir(dir):
         os.remove(os.path.join(dir, f))
 
 # non-pandas line by line reading of a json line separated file in utf8 encoding
-def read_jl_lines(filepath):
-    file = open(filepath, "r", encoding = "utf8")
-    lines = []
-    for line in file:
-        lines.append(json.loads(line))
-    file.close()
+# lazily yields one decoded line at a time, so memory use stays constant
+# ids - optional set of ticket ids to keep, see scan_json_lines
+def read_jl_lines(filepath, ids = None):
+    for lines in iter_line_blocks(filepath):
+        if ids is not None:
+            lines = filter_lines_by_id(lines, ids)
+        for line in lines:
+            yield json_loads(line)
+
+# yields the tickets of a json export one decoded record (dict) at a time
+# ids - optional set of ticket ids to keep, see scan_json_lines
+# fields, comment_fields - optional projection, see project_ticket
+def iter_tickets(filepath, ids = None, fields = None, comment_fields = None):
+    for ticket in read_jl_lines(filepath, ids):
+        yield project_ticket(ticket, fields, comment_fields)
+
+# generator stages to chain onto iter_tickets. Each takes an iterable of 
+# records and lazily yields records (or lists of records for batch_records)
+
+# keeps the records for which predicate(record) is True
+def filter_records(records, predicate):
+    for record in records:
+        if predicate(record):
+            yield record
+
+# yields fxn(record) for every record
+def map_records(records, fxn):
+    for record in records:
+        yield fxn(record)
+
+# groups records into lists of n; the last list may be shorter
+def batch_records(records, n):
+    records = iter(records)
+    batch = list(itertools.islice(records, n))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(records, n))
+
+# record version of trim_comments, returns a new record with each comment 
+# replaced by comment[mode]
+def trim_record_comments(record, mode = "body"):
+    comments = [comment[mode] for comment in record["comments"]]
+    return {"id": record["id"], "comments": comments}
+
+# record version of flatten_comments, yields one record per comment
+def flatten_record(record):
+    for i, comment in enumerate(record["comments"]):
+        yield {"id": record["id"], "comment_index": i, "comments": comment}
 
 # colnames must be a list of strings, legal column names for the pandas 
 # dataframe data
@@ -83,14 +651,31 @@ def get_columns(data, colnames):
 def get_colnames(data):
     return list(data.comments)
 
-def export(data, name = "output", filetype = "csv"):
+# returns the rows of a df as a list of dicts with missing values as None
+def get_records(data):
+    data = data.astype(object).where(data.notna(), None)
+    return data.to_dict(orient = "records")
+
+# writes a df as line separated json through the selected json backend
+# mode - "w" to overwrite target, "a" to append to it
+def write_json_lines(data, target, mode = "w"):
+    with open(target, mode, encoding = "utf8") as file:
+        for record in get_records(data):
+            file.write(json_dumps(record) + "\n")
+
+# append - add the rows to the end of an existing output instead of 
+# overwriting it (a csv header is only written if the file is new)
+def export(data, name = "output", filetype = "csv", append = False):
     target = f"data/parser_output/{name}.{filetype}"
     if (filetype == "json"):
-        data.to_json(target, orient = "records", 
-                     force_ascii = False, lines = True)
+        write_json_lines(data, target, "a" if append else "w")
         return
     if (filetype == "csv"):
-        data.to_csv(target)
+        if (append):
+            data.to_csv(target, mode = "a", 
+                        header = not os.path.exists(target))
+        else:
+            data.to_csv(target)
         return
     assert False, "unsupported file type in export fxn"
 
@@ -107,63 +692,931 @@ def split_data(data, splits):
         if (i == splits - 1): # if last iteration, take all the remaining data
             tmp = data[(split_length * 1):]
         target = f"data/parser_output/split{i + 1}.json"
-        tmp.to_json(target, orient = "records", 
-                    force_ascii = False, lines = True)
+        write_json_lines(tmp, target)
 
-# to be applied to comment data
-# input "thread" is a list of dictionaries, where each dict is an email
-# fxn is destructive, returns None
-def trim_thread_comments(thread, mode = "body"):
-    for i in range(len(thread)):
-        thread[i] = thread[i][mode]
+# pauses the garbage collector for the block (if it was running). Building 
+# many small lists or pulling values out of many dicts otherwise sets off 
+# collections that walk every comment dict, which takes most of the time.
+@contextlib.contextmanager
+def paused_gc():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if (enabled):
+            gc.enable()
+
+# offsets of each thread in the threads laid end to end: thread i is at 
+# [offsets[i], offsets[i + 1])
+# threads - list of lists
+def get_thread_offsets(threads):
+    offsets = np.zeros(len(threads) + 1, dtype = np.int64)
+    np.cumsum(np.fromiter(map(len, threads), dtype = np.int64, 
+                          count = len(threads)), out = offsets[1:])
+    return offsets
+
+# pulls comment[mode] out of every comment of every thread in one pass, 
+# into an offsets + values layout: values is a flat list of the extracted 
+# values and thread i is values[offsets[i]:offsets[i + 1]]
+# comments - pandas Series of threads, see trim_comments
+def get_comment_values(comments, mode = "body"):
+    threads = comments.to_list()
+    offsets = get_thread_offsets(threads)
+    with paused_gc():
+        values = list(map(operator.itemgetter(mode), 
+                          itertools.chain.from_iterable(threads)))
+    return offsets, values
 
 # data - a pandas dataframe including a column titled "comments"
 # ASSUMPTION: comments is a pandas Series of threads, each thread being a 
 # list of emails, each represented as a dictionary
 # mode - the value in each dictionary we want to extract; usually "body"
-# NOTE: this function is DESTRUCTIVE
+# returns a copy of data with each thread replaced by the list of its 
+# comment[mode] values; data itself is left as is
 def trim_comments(data, mode = "body"):
-    comments = data.comments
-    comments.apply(trim_thread_comments, mode = mode)
+    offsets, values = get_comment_values(data.comments, mode)
+    bounds = zip(offsets[:-1].tolist(), offsets[1:].tolist())
+    with paused_gc():
+        threads = [values[lo:hi] for lo, hi in bounds]
+    comments = pd.Series(threads, index = data.index, dtype = object)
+    return data.assign(comments = comments)
 
 # splits should be the # of splits desired if provided
 # if splits are desired, required output is json.
+# append - add to an existing output, see export (ignored with splits)
+# fields - the columns to export, FLATTENED_FIELDS for flattened data
 def export_comments(data, target = "comments", filetype = "csv", 
-                    splits = False):
+                    splits = False, append = False, fields = REPORT_FIELDS):
     # select down the data to only these columns
-    data = get_columns(data, ["id", "comments"])
+    data = get_columns(data, fields)
     if(splits):
         split_data(data, splits)
     else:
-        export(data, name = target, filetype = filetype)
+        export(data, name = target, filetype = filetype, append = append)
+
+# writes the comments and flattened_emails outputs of a report from a stream
+# of trimmed ticket dfs, one df at a time. Row numbers continue across the 
+# dfs, so the outputs are the same as for the concatenated df.
+# tag - appended to the output names, e.g. "_042020" -> comments_042020.csv
+# append - add to existing outputs instead of replacing them
+# counts - optional dict with the "rows" and "emails" already in the outputs;
+# numbering continues from there and the dict is updated as rows are written
+def export_report(frames, tag = "", append = False, counts = None):
+    if (counts is None):
+        counts = {"rows": 0, "emails": 0}
+    first = True
+    for data in frames:
+        if (len(data) == 0):
+            continue
+        rows = counts["rows"]
+        emails = counts["emails"]
+        data = data.set_axis(range(rows, rows + len(data)))
+        flattened = flatten_comments(data)
+        flattened = flattened.set_axis(range(emails, 
+                                             emails + len(flattened)))
+        export_comments(data, "comments" + tag, append = append or not first)
+        export_comments(flattened, "flattened_emails" + tag, 
+                        append = append or not first, 
+                        fields = FLATTENED_FIELDS)
+        counts["rows"] += len(data)
+        counts["emails"] += len(flattened)
+        first = False
+    # nothing to export, still leave (empty) outputs behind
+    if (first and not append):
+        export_comments(pd.DataFrame(columns = REPORT_FIELDS), 
+                        "comments" + tag)
+        export_comments(pd.DataFrame(columns = FLATTENED_FIELDS), 
+                        "flattened_emails" + tag, fields = FLATTENED_FIELDS)
 
 # the merge is an inner join, so if a ticket exists in BOTH the .csv and the
 # .json, then its comments will be represented.
-def load_merged_data(customer = ""):
-    data = load_first_json()
-    lookup = load_first_csv()
-    lookup = lookup.rename(columns = {"Id": "id", 
-                                      "Customer [list]": "customer"})
-    lookup = get_columns(lookup, ["id", "customer"])
+# fields, comment_fields - optional projection, see project_ticket
+# cache - use the parse cache, see load_json
+def load_merged_data(customer = "", fields = None, comment_fields = None,
+                     cache = False):
+    data = load_first_json(fields = fields, comment_fields = comment_fields,
+                           cache = cache)
+    lookup = load_first_lookup()
     # want to merge json and csv on id
     # id is capitalized in the csv and not in the json
     data = data.merge(lookup, how = "inner", on = "id")
     # filter by customer if requested
     if (customer != ""):
-        data = data[data["customer"] == customer]
+        members = customer_members(build_customer_index(lookup), customer)
+        data = data[data.id.isin(members)]
     return(data)
 
-# uses numpy to flatten a list
-def flatten(lst):
-    return list(np.concatenate(lst).flat)
+# the "Customer [list]" values of a lookup as a set of stripped strings. 
+# Zendesk doesn't escape the separator, so these are what tells a list of 
+# customers from a customer whose name contains CUSTOMER_SEPARATOR.
+def get_known_customers(values):
+    return set(value.strip() for value in values if isinstance(value, str))
+
+# the customer names of one "Customer [list]" value, sorted and unique. The
+# whole value is always one of them, so a ticket is found by its exact value
+# as well. The value is only split into its parts if every part is a known 
+# customer; a name like "Acme, Inc." stays whole unless "Inc." is a customer.
+# known - set of customer values, see get_known_customers
+def split_customers(value, known):
+    if (not isinstance(value, str) or value.strip() == ""):
+        return []
+    parts = (name.strip() for name in value.split(CUSTOMER_SEPARATOR))
+    parts = set(name for name in parts if name != "")
+    if (not parts <= known):
+        return [value.strip()]
+    return sorted(parts | {value.strip()})
+
+# builds the customer membership index of a lookup df: an inverted index 
+# from each customer name to the sorted ids of its tickets, stored CSR style
+# as "customers" (sorted names), "offsets" and "ids" (the ids of customer i
+# are ids[offsets[i]:offsets[i + 1]]). The same (id, customer) pairs sorted 
+# by id are kept as "pair_ids" and "pair_customers" for routing tickets; 
+# they leave out the whole value of a list that was split into customers, so
+# a ticket is routed to each of its customers but not to the list itself.
+# Each distinct "Customer [list]" value is only split once.
+def build_customer_index(lookup):
+    values = lookup.customer.astype("category")
+    codes = values.cat.codes.to_numpy()
+    ids = lookup.id.to_numpy(dtype = np.int64)
+    categories = values.cat.categories
+    known = get_known_customers(categories)
+    split = [split_customers(value, known) for value in categories]
+    names = sorted(set(itertools.chain.from_iterable(split)))
+    position = {name: i for i, name in enumerate(names)}
+    # the customers of every category as one flat array, the last (empty) 
+    # slot is for missing values (code -1)
+    members = [np.array([position[name] for name in value], dtype = np.int64)
+               for value in split] + [np.empty(0, dtype = np.int64)]
+    routed = [np.array([len(value) == 1 or name != whole.strip() 
+                        for name in value], dtype = bool)
+              for value, whole in zip(split, categories)] + \
+             [np.empty(0, dtype = bool)]
+    sizes = np.array([len(member) for member in members])
+    starts = np.cumsum(sizes) - sizes
+    flat = np.concatenate(members)
+    flat_routed = np.concatenate(routed)
+    # one (id, customer) pair per customer of every ticket
+    counts = sizes[codes]
+    rows = np.repeat(np.arange(len(ids)), counts)
+    within = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, 
+                                              counts)
+    slots = starts[codes[rows]] + within
+    pair_customers = flat[slots]
+    pair_ids = ids[rows]
+    by_customer = np.lexsort((pair_ids, pair_customers))
+    by_id = np.lexsort((pair_customers, pair_ids))
+    by_id = by_id[flat_routed[slots][by_id]]
+    return {"customers": np.array(names, dtype = object),
+            "offsets": np.searchsorted(pair_customers[by_customer], 
+                                       np.arange(len(names) + 1)),
+            "ids": pair_ids[by_customer], 
+            "pair_ids": pair_ids[by_id], 
+            "pair_customers": pair_customers[by_id]}
+
+# warns if customer isn't in a membership index; the report of a misspelled
+# customer would otherwise just come out empty
+def check_customer(index, customer):
+    if (len(customer_members(index, customer)) == 0):
+        warnings.warn(f"customer {customer!r} is not in the lookup")
 
+# sorted array of the ticket ids of one customer in a membership index
+def customer_members(index, customer):
+    i = np.searchsorted(index["customers"], customer)
+    if (i == len(index["customers"]) or index["customers"][i] != customer):
+        return np.empty(0, dtype = np.int64)
+    return index["ids"][index["offsets"][i]:index["offsets"][i + 1]]
+
+# repeats every row of chunk once per customer of its ticket, with that 
+# customer's name in a "customer" column; rows are in chunk order
+# wanted - optional list of customer names to keep; names that aren't in the
+# index match nothing
+def route_customers(chunk, index, wanted = None):
+    chunk_ids = chunk.id.to_numpy(dtype = np.int64)
+    lo = np.searchsorted(index["pair_ids"], chunk_ids, side = "left")
+    counts = np.searchsorted(index["pair_ids"], chunk_ids, 
+                             side = "right") - lo
+    rows = np.repeat(np.arange(len(chunk)), counts)
+    pairs = np.repeat(lo, counts) + np.arange(len(rows)) - \
+        np.repeat(np.cumsum(counts) - counts, counts)
+    customers = index["pair_customers"][pairs]
+    if (wanted is not None):
+        names = np.asarray(wanted, dtype = object)
+        codes = np.searchsorted(index["customers"], names)
+        found = codes < len(index["customers"])
+        found[found] = index["customers"][codes[found]] == names[found]
+        keep = np.isin(customers, codes[found])
+        rows = rows[keep]
+        customers = customers[keep]
+    return chunk.iloc[rows].assign(customer = index["customers"][customers])
+
+# returns the set of ticket ids the lookup assigns to customer
+# lookup - df with "id" and "customer" columns
+def get_customer_ids(lookup, customer):
+    return set(customer_members(build_customer_index(lookup), 
+                                customer).tolist())
+
+# keeps the rows of data whose raw "customer" value lists customer; each 
+# distinct value is only split once
+# known - set of customer values, see split_customers
+def filter_customer(data, customer, known):
+    keep = [value for value in data.customer.unique() 
+            if customer in split_customers(value, known)]
+    return data[data.customer.isin(keep)]
+
+# the lookup index of a report on customer and the set of ticket ids worth 
+# decoding (None when every customer is reported), sharing one membership 
+# index between the two
+def get_report_lookup(lookup, customer):
+    if (customer == ""):
+        return build_lookup_index(lookup), None
+    members = build_customer_index(lookup)
+    check_customer(members, customer)
+    ids = set(customer_members(members, customer).tolist())
+    return build_lookup_index(lookup, customer, members), ids
+
+# turns an id/customer lookup df into a lookup index that chunks can probe 
+# without a merge: the ticket ids sorted as a numpy array, and for each id a
+# code into the array of customer names
+# customer - if given, only tickets that list that customer are kept, so 
+# the customer filter runs before the join
+# members - the membership index of lookup (see build_customer_index) if it
+# was already built; only needed with a customer
+def build_lookup_index(lookup, customer = "", members = None):
+    if (customer != ""):
+        if (members is None):
+            members = build_customer_index(lookup)
+        lookup = lookup[lookup.id.isin(customer_members(members, customer))]
+    lookup = lookup.drop_duplicates(subset = "id", keep = "last")
+    codes, customers = pd.factorize(lookup.customer)
+    ids = lookup.id.to_numpy(dtype = np.int64)
+    order = np.argsort(ids, kind = "stable")
+    return {"ids": ids[order], "codes": codes[order], 
+            "customers": np.asarray(customers, dtype = object),
+            "customer": customer}
+
+# the lookup index version of chunk.merge(lookup, how = "inner", on = "id"):
+# ids are binary searched in the sorted index and the customer names taken 
+# from the matching positions
+# lo, hi - optional window of the index to search in, see merge_join_chunk
+def probe_lookup(chunk, index, lo = 0, hi = None):
+    ids = index["ids"][lo:hi]
+    if (len(ids) == 0 or len(chunk) == 0):
+        return chunk.iloc[0:0].assign(customer = pd.Series(dtype = object))
+    chunk_ids = chunk.id.to_numpy(dtype = np.int64)
+    pos = np.minimum(np.searchsorted(ids, chunk_ids), len(ids) - 1)
+    hit = ids[pos] == chunk_ids
+    codes = index["codes"][lo + pos[hit]]
+    customers = np.where(codes >= 0, 
+                         index["customers"].take(np.maximum(codes, 0)), None)
+    return chunk[hit].assign(customer = customers)
+
+# state of a merge join over one pass of a json export, see merge_join_chunk
+def new_merge_state():
+    return {"cursor": 0, "last": None, "sorted": True}
+
+# probe_lookup for exports ordered by ticket id (as zendesk writes them). 
+# The lookup index is sorted, so both sides are walked forward together: 
+# each chunk is only searched against the part of the index between the 
+# previous chunk's last id and its own last id, and the index is never 
+# searched behind the cursor again; once the whole index is passed, chunks 
+# that are still in order are not searched at all. As soon as a chunk turns
+# out not to be in order, the state falls back to plain probe_lookup for the
+# rest of the pass. Order is only known for the chunks seen so far, so the 
+# pass must still read every chunk: a ticket appended out of order at the 
+# end of the export is found by the fallback.
+# state - dict from new_merge_state, updated in place
+def merge_join_chunk(chunk, index, state):
+    chunk_ids = chunk.id.to_numpy(dtype = np.int64)
+    if (state["sorted"] and len(chunk_ids) > 0):
+        state["sorted"] = bool(np.all(chunk_ids[1:] >= chunk_ids[:-1])) and \
+            (state["last"] is None or chunk_ids[0] >= state["last"])
+    if (not state["sorted"]):
+        return probe_lookup(chunk, index)
+    if (len(chunk_ids) == 0):
+        return probe_lookup(chunk, index, state["cursor"], state["cursor"])
+    lo = state["cursor"]
+    hi = lo + int(np.searchsorted(index["ids"][lo:], chunk_ids[-1], 
+                                  side = "right"))
+    data = probe_lookup(chunk, index, lo, hi)
+    # the next chunk may start with this chunk's last id again, so its 
+    # entries stay ahead of the cursor
+    state["cursor"] = lo + int(np.searchsorted(index["ids"][lo:hi], 
+                                               chunk_ids[-1], side = "left"))
+    state["last"] = int(chunk_ids[-1])
+    return data
+
+# one row per comment of the trimmed threads in data, see FLATTENED_FIELDS.
+# The threads are laid end to end as offsets + values: ids and positions are
+# repeated from the offsets and the comments themselves are not copied.
 def flatten_comments(data):
-    flattened = flatten(list(data.comments))
-    lengths = data.comments.apply(len)
-    idx = list(np.repeat(lengths.index, lengths.values))
-    result = pd.DataFrame(data = {"id": idx, "comments": flattened})
-    return result
+    threads = data.comments.to_list()
+    rows = get_comment_rows(data, threads)
+    rows["comments"] = list(itertools.chain.from_iterable(threads))
+    return pd.DataFrame(rows)
+
+# the id and comment_index columns of the comments of data, threads being 
+# data.comments as a list
+def get_comment_rows(data, threads):
+    offsets = get_thread_offsets(threads)
+    lengths = np.diff(offsets)
+    positions = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+    ids = np.repeat(data.id.to_numpy(), lengths)
+    return {"id": ids, "comment_index": positions}
+
+# flatten_comments for untrimmed threads: one row per comment, with one 
+# column per key in modes instead of a single comments column. Columns are
+# typed by their values (e.g. Int64, boolean, string), timestamp keys (see
+# TIMESTAMP_SUFFIX) are parsed to UTC datetimes in one call per column, and
+# comments without a key get a missing value.
+# modes - list of comment keys, e.g. ["author_id", "created_at", "body"]
+def get_comment_table(data, modes):
+    threads = data.comments.to_list()
+    table = get_comment_rows(data, threads)
+    with paused_gc():
+        comments = list(itertools.chain.from_iterable(threads))
+        columns = {mode: [comment.get(mode) for comment in comments] 
+                   for mode in modes}
+    for mode, values in columns.items():
+        if (mode.endswith(TIMESTAMP_SUFFIX)):
+            table[mode] = pd.to_datetime(values, utc = True, 
+                                         errors = "coerce")
+            continue
+        try:
+            table[mode] = pd.array(values)
+        except (ValueError, TypeError): # e.g. lists, which stay objects
+            table[mode] = pd.Series(values, dtype = object).array
+    return pd.DataFrame(table)
+
+
+#####################
+#### Parse Cache ####
+#####################
+
+# parsed json exports are cached as parquet files in CACHE_DIR. Columns 
+# holding dicts or lists (like comments) are stored as json strings and 
+# decoded again on load. CACHE_DIR/manifest.json records, per cache key, the 
+# source file, the size of the cache file, its nested columns and when it 
+# was last used.
+
+# identifies the contents of a file without reading all of it: the path, 
+# size, modification time and a hash of the first and last 
+# FINGERPRINT_SAMPLE bytes
+def get_file_fingerprint(filepath):
+    stat = os.stat(filepath)
+    digest = hashlib.sha256()
+    digest.update(os.path.abspath(filepath).encode("utf8"))
+    digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode("utf8"))
+    with open(filepath, "rb") as file:
+        digest.update(file.read(FINGERPRINT_SAMPLE))
+        file.seek(max(stat.st_size - FINGERPRINT_SAMPLE, 0))
+        digest.update(file.read(FINGERPRINT_SAMPLE))
+    return digest.hexdigest()
+
+# the cache key of a json file loaded with a given projection
+def get_cache_key(filepath, fields = None, comment_fields = None):
+    projection = json.dumps([fields, comment_fields]).encode("utf8")
+    digest = hashlib.sha256(get_file_fingerprint(filepath).encode("utf8"))
+    digest.update(projection)
+    return digest.hexdigest()[:32]
+
+def read_cache_manifest():
+    target = os.path.join(CACHE_DIR, "manifest.json")
+    if (not os.path.exists(target)):
+        return {}
+    with open(target, "r", encoding = "utf8") as file:
+        return json.load(file)
+
+def write_cache_manifest(manifest):
+    os.makedirs(CACHE_DIR, exist_ok = True)
+    target = os.path.join(CACHE_DIR, "manifest.json")
+    with open(target + ".tmp", "w", encoding = "utf8") as file:
+        json.dump(manifest, file)
+    os.replace(target + ".tmp", target)
+
+# returns the manifest entry of a cache key, or None if it isn't cached
+# (or pyarrow is missing). A hit marks the entry as recently used.
+def get_cache_entry(key):
+    if (pa is None):
+        return None
+    manifest = read_cache_manifest()
+    entry = manifest.get(key)
+    if (entry is None or 
+        not os.path.exists(os.path.join(CACHE_DIR, key + ".parquet"))):
+        return None
+    entry["used"] = time.time()
+    write_cache_manifest(manifest)
+    return entry
+
+# deletes the least recently used cache files until the cache fits in limit
+def evict_cache(manifest, limit = CACHE_LIMIT):
+    total = sum(entry["bytes"] for entry in manifest.values())
+    for key in sorted(manifest, key = lambda key: manifest[key]["used"]):
+        if (total <= limit):
+            break
+        total -= manifest[key]["bytes"]
+        del manifest[key]
+        target = os.path.join(CACHE_DIR, key + ".parquet")
+        if (os.path.exists(target)):
+            os.remove(target)
+    return manifest
+
+# invalidates the cache of one source file, or the whole cache if no
+# filepath is given
+def clear_json_cache(filepath = None):
+    if (filepath is None):
+        shutil.rmtree(CACHE_DIR, ignore_errors = True)
+        return
+    manifest = read_cache_manifest()
+    source = os.path.abspath(filepath)
+    for key in [key for key in manifest if manifest[key]["source"] == source]:
+        del manifest[key]
+        target = os.path.join(CACHE_DIR, key + ".parquet")
+        if (os.path.exists(target)):
+            os.remove(target)
+    write_cache_manifest(manifest)
+
+# names of the columns of a df that hold dicts or lists
+def get_nested_columns(data):
+    nested = []
+    for col in data.columns:
+        if (data[col].dtype == object and 
+            data[col].map(lambda x: isinstance(x, (dict, list))).any()):
+            nested.append(col)
+    return nested
+
+# json encodes (or decodes) the nested columns of a df, returning a new df
+def encode_nested_columns(data, nested):
+    encoded = {col: data[col].map(lambda x: None if x is None 
+                                  else json_dumps(x)) for col in nested}
+    return data.assign(**encoded)
 
+def decode_nested_columns(data, nested):
+    decoded = {col: data[col].map(lambda x: None if x is None 
+                                  else json_loads(x)) for col in nested}
+    return data.assign(**decoded)
+
+# passes the dfs of a stream through unchanged while writing them to the 
+# cache under key. The cache file is only registered once the stream has 
+# been read to the end; if a later df doesn't fit the schema of the first 
+# one, caching is abandoned and the stream carries on uncached.
+def write_json_cache(frames, key, filepath):
+    os.makedirs(CACHE_DIR, exist_ok = True)
+    target = os.path.join(CACHE_DIR, key + ".parquet")
+    writer = None
+    nested = None
+    complete = False
+    try:
+        for data in frames:
+            if (writer is not False):
+                try:
+                    if (nested is None):
+                        nested = get_nested_columns(data)
+                    table = pa.Table.from_pandas(
+                        encode_nested_columns(data, nested), 
+                        schema = None if writer is None else writer.schema,
+                        preserve_index = False)
+                    if (writer is None):
+                        writer = pq.ParquetWriter(target, table.schema)
+                    writer.write_table(table)
+                except (pa.ArrowException, ValueError, TypeError):
+                    if (writer is not None):
+                        writer.close()
+                    writer = False
+            yield data
+        complete = True
+    finally:
+        if (writer):
+            writer.close()
+        if (complete and writer):
+            manifest = read_cache_manifest()
+            manifest[key] = {"source": os.path.abspath(filepath), 
+                             "bytes": os.path.getsize(target), 
+                             "nested": nested, "used": time.time()}
+            write_cache_manifest(evict_cache(manifest))
+        elif (os.path.exists(target)):
+            os.remove(target)
+
+# yields the cached dfs of key in chunks of (up to) n rows
+# ids - optional set of ticket ids to keep; the other rows are dropped from 
+# each arrow batch, before their nested columns are json decoded
+def read_json_cache(key, entry, n, ids = None):
+    cached = pq.ParquetFile(os.path.join(CACHE_DIR, key + ".parquet"))
+    if (ids is not None):
+        wanted = pa.array(sorted(ids), type = pa.int64())
+    for batch in cached.iter_batches(batch_size = n):
+        if (ids is not None):
+            batch = batch.filter(pc.is_in(batch.column("id"), 
+                                          value_set = wanted))
+            if (batch.num_rows == 0):
+                continue
+        yield decode_nested_columns(batch.to_pandas(), entry["nested"])
+
+####################
+#### Line Index ####
+####################
+
+# a sidecar file "<export>.idx.npy" next to an uncompressed json export 
+# holds the (id, offset, length) of every line, sorted by id, so single 
+# tickets can be read without streaming the whole export. "<export>.idx.json"
+# records the fingerprint (see get_file_fingerprint) of the export the index
+# was built from.
+
+def get_index_path(filepath):
+    return filepath + ".idx.npy"
+
+def get_index_header_path(filepath):
+    return filepath + ".idx.json"
+
+# yields (byte offset, raw line) for every non blank line of a json file
+def iter_line_offsets(filepath, block_size = SCAN_BLOCK_SIZE):
+    with open(filepath, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if (size == 0):
+            return
+        with mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+            pos = 0
+            while pos < size:
+                stop = min(pos + block_size, size)
+                if (stop < size):
+                    cut = mm.rfind(b"\n", pos, stop)
+                    if (cut == -1):
+                        cut = mm.find(b"\n", stop)
+                    stop = size if cut == -1 else cut + 1
+                offset = pos
+                for line in mm[pos:stop].split(b"\n"):
+                    if (line and not line.isspace()):
+                        yield offset, line
+                    offset += len(line) + 1
+                pos = stop
+
+# scans a json export once and saves its sidecar line index
+def build_line_index(filepath):
+    assert not is_compressed(filepath), "can't index a compressed file"
+    rows = [(scan_line_id(line), offset, len(line)) 
+            for offset, line in iter_line_offsets(filepath)]
+    rows = [row for row in rows if row[0] is not None]
+    index = np.array(rows, dtype = LINE_INDEX_DTYPE)
+    index = index[np.argsort(index["id"], kind = "stable")]
+    fingerprint = get_file_fingerprint(filepath)
+    np.save(get_index_path(filepath), index)
+    # the header goes last, an interrupted build is rebuilt next time
+    with open(get_index_header_path(filepath), "w", encoding = "utf8") as file:
+        json.dump({"fingerprint": fingerprint}, file)
+    return index
+
+# memory maps the line index of a json export, (re)building it first if it
+# is missing or was built from a different version of the export. Comparing
+# fingerprints rather than modification times also catches an export that 
+# was swapped for another copy with an older (or preserved) mtime.
+def load_line_index(filepath):
+    target = get_index_path(filepath)
+    header_path = get_index_header_path(filepath)
+    header = None
+    if (os.path.exists(target) and os.path.exists(header_path)):
+        with open(header_path, "r", encoding = "utf8") as file:
+            header = json.load(file)
+    if (header is None or 
+        header.get("fingerprint") != get_file_fingerprint(filepath)):
+        build_line_index(filepath)
+    return np.load(target, mmap_mode = "r")
+
+# reads length bytes at offset from an open file descriptor
+def read_range(fd, offset, length):
+    if (hasattr(os, "pread")):
+        return os.pread(fd, length, offset)
+    os.lseek(fd, offset, os.SEEK_SET) # os.pread is missing on Windows
+    return os.read(fd, length)
+
+# returns a df of the tickets with the given ids, in id order, reading only
+# their lines from the export. Ids missing from the export are skipped.
+# ids - iterable of ticket ids
+# filepath - json export; defaults to the first json in the input directory
+# fields, comment_fields - optional projection, see project_ticket
+def get_tickets(ids, filepath = None, fields = None, comment_fields = None):
+    if (filepath is None):
+        filepath = get_filepath_by_type("data/parser_input", "json")
+    index = load_line_index(filepath)
+    ids = np.unique(np.asarray(list(ids), dtype = np.int64))
+    pos = np.searchsorted(index["id"], ids)
+    pos = pos[pos < len(index)]
+    found = index[pos]
+    found = found[np.isin(found["id"], ids)]
+    fd = os.open(filepath, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        lines = [read_range(fd, int(row["offset"]), int(row["length"])) 
+                 for row in found]
+    finally:
+        os.close(fd)
+    return parse_json_lines(lines, fields, comment_fields)
+
+###########################
+#### Partition Writers ####
+###########################
+
+# partition writers append dfs to many csv files (one per partition key) 
+# while keeping both memory and open file handles bounded: rows are buffered
+# per partition and the biggest buffer is written out once buffer_rows rows
+# are waiting in total; at most max_open files are open at once, the least
+# recently written one is closed to make room.
+
+# dirpath - folder the partition folders are created in
+def open_partition_writers(dirpath = PARTITION_DIR, max_open = 64, 
+                           buffer_rows = 100000):
+    return {"dir": dirpath, "max_open": max_open, 
+            "buffer_rows": buffer_rows, "buffers": {}, "buffered": 0,
+            "handles": collections.OrderedDict(), "started": set(),
+            "folders": {}, "taken": set()}
+
+# file of a partition key (partition, name): <dir>/<partition>/<name>.csv
+# characters that can't appear in a folder name are replaced by "_". Two 
+# partitions that would share a folder (e.g. "A/B" and "A_B", or names that 
+# only differ in case on case-insensitive file systems) must not overwrite 
+# each other: the later one gets a "_2", "_3", ... suffix.
+def get_partition_path(writers, key):
+    folders = writers["folders"]
+    if (key[0] not in folders):
+        base = re.sub(r'[\\/:*?"<>|]', "_", str(key[0])).strip() or "_"
+        folder = base
+        suffix = 1
+        while (folder.lower() in writers["taken"]):
+            suffix += 1
+            folder = f"{base}_{suffix}"
+        folders[key[0]] = folder
+        writers["taken"].add(folder.lower())
+    return os.path.join(writers["dir"], folders[key[0]], key[1] + ".csv")
+
+# queues the rows of data for partition key; the index is written as is
+def write_partition(writers, key, data):
+    writers["buffers"].setdefault(key, []).append(data)
+    writers["buffered"] += len(data)
+    if (writers["buffered"] >= writers["buffer_rows"]):
+        biggest = max(writers["buffers"], 
+                      key = lambda k: sum(map(len, writers["buffers"][k])))
+        flush_partition(writers, biggest)
+
+# writes out the buffered rows of one partition
+def flush_partition(writers, key):
+    frames = writers["buffers"].pop(key, [])
+    if (len(frames) == 0):
+        return
+    writers["buffered"] -= sum(map(len, frames))
+    handles = writers["handles"]
+    if (key in handles):
+        handles.move_to_end(key)
+    else:
+        if (len(handles) >= writers["max_open"]):
+            handles.popitem(last = False)[1].close()
+        target = get_partition_path(writers, key)
+        os.makedirs(os.path.dirname(target), exist_ok = True)
+        # the first write of a run replaces output left over from earlier runs
+        mode = "a" if key in writers["started"] else "w"
+        handles[key] = open(target, mode, encoding = "utf8", newline = "")
+    pd.concat(frames).to_csv(handles[key], 
+                             header = key not in writers["started"])
+    writers["started"].add(key)
+
+# flushes every buffer and closes every file
+def close_partition_writers(writers):
+    for key in list(writers["buffers"]):
+        flush_partition(writers, key)
+    for handle in writers["handles"].values():
+        handle.close()
+    writers["handles"].clear()
+
+########################
+#### Partition Join ####
+########################
+
+# for lookups that don't fit in memory next to the json chunks: both the 
+# lookup csvs and the json lines are hash partitioned by id % buckets into 
+# files in JOIN_DIR, then joined one bucket at a time, so only one bucket of
+# the lookup is ever in memory
+
+# kind - "lookup" (csv rows) or "tickets" (raw json lines)
+def get_bucket_path(dirpath, kind, bucket):
+    extension = "csv" if kind == "lookup" else "json"
+    return os.path.join(dirpath, f"{kind}{bucket:05d}.{extension}")
+
+# the distinct customer values of lookup csvs (see get_known_customers), 
+# read one column and one chunk at a time
+def get_csv_known_customers(filepaths):
+    known = set()
+    for filepath in filepaths:
+        reader = pd.read_csv(filepath, usecols = ["Customer [list]"],
+                             dtype = {"Customer [list]": str},
+                             chunksize = LOOKUP_CHUNK_ROWS)
+        for chunk in reader:
+            known |= get_known_customers(chunk["Customer [list]"].unique())
+    return known
+
+# streams the lookup csvs into bucket files of (id, customer) rows and 
+# returns the number of rows written
+# customer - if given, only rows listing that customer are kept
+def partition_lookups(filepaths, buckets, dirpath = JOIN_DIR, customer = ""):
+    if (customer != ""):
+        known = get_csv_known_customers(filepaths)
+    written = 0
+    for filepath in filepaths:
+        reader = pd.read_csv(filepath, usecols = ["Id", "Customer [list]"],
+                             dtype = {"Id": "int64", "Customer [list]": str},
+                             chunksize = LOOKUP_CHUNK_ROWS)
+        for chunk in reader:
+            chunk = chunk.rename(columns = {"Id": "id", 
+                                            "Customer [list]": "customer"})
+            chunk = get_columns(chunk, ["id", "customer"])
+            if (customer != ""):
+                chunk = filter_customer(chunk, customer, known)
+            written += len(chunk)
+            for bucket, rows in chunk.groupby(chunk.id % buckets):
+                target = get_bucket_path(dirpath, "lookup", bucket)
+                rows.to_csv(target, mode = "a", index = False,
+                            header = not os.path.exists(target))
+    return written
+
+# streams the raw lines of a json export into bucket files, without 
+# decoding them
+def partition_tickets(filepath, buckets, dirpath = JOIN_DIR):
+    for lines in iter_line_blocks(filepath):
+        groups = {}
+        for line in lines:
+            ticket_id = scan_line_id(line)
+            if (ticket_id is not None):
+                groups.setdefault(ticket_id % buckets, []).append(line)
+        for bucket, group in groups.items():
+            with open(get_bucket_path(dirpath, "tickets", bucket), 
+                      "ab") as file:
+                file.write(b"\n".join(group) + b"\n")
+
+# yields the json chunks of every bucket joined with that bucket's lookup, 
+# bucket by bucket. Later lookup files win for ids listed more than once, as
+# in load_all_csvs.
+def iter_bucket_joins(buckets, n, dirpath = JOIN_DIR, fields = None, 
+                      comment_fields = None):
+    for bucket in range(buckets):
+        lookup_path = get_bucket_path(dirpath, "lookup", bucket)
+        tickets_path = get_bucket_path(dirpath, "tickets", bucket)
+        if (not os.path.exists(lookup_path) or 
+            not os.path.exists(tickets_path)):
+            continue
+        lookup = pd.read_csv(lookup_path, dtype = {"id": "int64", 
+                                                   "customer": str})
+        index = build_lookup_index(lookup)
+        for lines in scan_json_lines(tickets_path, n):
+            chunk = parse_json_lines(lines, fields, comment_fields)
+            yield probe_lookup(chunk, index)
+
+######################
+#### Ingest State ####
+######################
+
+# STATE_FILE maps "<json path>|<customer>" to how far the last incremental
+# run got: the byte offset it read up to, the highest ticket id it exported,
+# a hash of the file contents before that offset, the size and modification
+# time of the outputs it wrote and how many rows they hold. Compressed files 
+# have no offset or hash, since they are always read from the start.
+
+def read_ingest_state():
+    if (not os.path.exists(STATE_FILE)):
+        return {}
+    with open(STATE_FILE, "r", encoding = "utf8") as file:
+        return json.load(file)
+
+def write_ingest_state(state):
+    with open(STATE_FILE + ".tmp", "w", encoding = "utf8") as file:
+        json.dump(state, file, indent = 2)
+    os.replace(STATE_FILE + ".tmp", STATE_FILE)
+
+# hash of the first min(length, FINGERPRINT_SAMPLE) bytes of a file, used to
+# tell an export that grew from one that was replaced
+def get_head_hash(filepath, length):
+    with open(filepath, "rb") as file:
+        head = file.read(min(length, FINGERPRINT_SAMPLE))
+    return hashlib.sha256(head).hexdigest()
+
+# {path: [size, modification time in ns]} of the outputs that exist
+def get_output_stamps(outputs):
+    stamps = {}
+    for output in outputs:
+        if (os.path.exists(output)):
+            stat = os.stat(output)
+            stamps[output] = [stat.st_size, stat.st_mtime_ns]
+    return stamps
+
+# passes dfs through unchanged, keeping the highest ticket id seen in 
+# marks["max_id"]
+def track_max_id(frames, marks):
+    for data in frames:
+        if (len(data) > 0):
+            top = int(data.id.max())
+            if (marks["max_id"] is None or top > marks["max_id"]):
+                marks["max_id"] = top
+        yield data
+
+# returns (byte offset, id high-water mark) to resume an export from
+# the offset is only trusted if the file still starts the same way and is at
+# least as long as before; otherwise the whole file is read again and only 
+# tickets above the high-water mark are new. Compressed files are always 
+# read from the start.
+def get_resume_point(filepath, entry):
+    if (entry is None):
+        return 0, None
+    if (is_compressed(filepath) or 
+        os.path.getsize(filepath) < entry["offset"] or
+        get_head_hash(filepath, entry["offset"]) != entry["head"]):
+        return 0, entry["max_id"]
+    return entry["offset"], None
+
+#######################
+#### Deduplication ####
+#######################
+
+# the same ticket shows up in every monthly export it was alive for. The 
+# dedup index (an sqlite database, DEDUP_DB) keeps, per ticket id, where the
+# line with the newest "updated_at" lives: (source file, offset, length). 
+# The index lives on disk, so deduplicating a year of exports needs neither
+# the tickets nor their ids in memory.
+
+# number of index rows written to sqlite per statement batch
+DEDUP_BATCH = 10000
+
+# indexes the newest version of every ticket in filepaths (uncompressed 
+# json exports). The index is reused while the exports are unchanged and 
+# rebuilt from scratch otherwise.
+def build_dedup_index(filepaths, db_path = DEDUP_DB):
+    fingerprints = {os.path.abspath(f): get_file_fingerprint(f) 
+                    for f in filepaths}
+    con = sqlite3.connect(db_path)
+    try:
+        con.execute("CREATE TABLE IF NOT EXISTS sources "
+                    "(path TEXT PRIMARY KEY, fingerprint TEXT)")
+        if (dict(con.execute("SELECT * FROM sources")) == fingerprints):
+            return
+        con.execute("DROP TABLE IF EXISTS tickets")
+        con.execute("DELETE FROM sources")
+        con.execute("CREATE TABLE tickets (id INTEGER PRIMARY KEY, "
+                    "updated_at TEXT, source TEXT, offset INTEGER, "
+                    "length INTEGER)")
+        # a later line replaces the stored one only if it is strictly newer
+        upsert = ("INSERT INTO tickets VALUES (?, ?, ?, ?, ?) "
+                  "ON CONFLICT(id) DO UPDATE SET "
+                  "updated_at = excluded.updated_at, "
+                  "source = excluded.source, offset = excluded.offset, "
+                  "length = excluded.length "
+                  "WHERE COALESCE(excluded.updated_at, '') > "
+                  "COALESCE(tickets.updated_at, '')")
+        for filepath in filepaths:
+            assert not is_compressed(filepath), \
+                "can't deduplicate a compressed file, decompress it first"
+            source = os.path.abspath(filepath)
+            rows = ((scan_line_id(line), scan_line_updated_at(line), source,
+                     offset, len(line)) 
+                    for offset, line in iter_line_offsets(filepath))
+            rows = (row for row in rows if row[0] is not None)
+            for batch in batch_records(rows, DEDUP_BATCH):
+                con.executemany(upsert, batch)
+        con.executemany("INSERT INTO sources VALUES (?, ?)", 
+                        fingerprints.items())
+        con.commit()
+    finally:
+        con.close()
+
+# yields batches of n raw lines, one line per ticket id, read back from the
+# exports through the dedup index (in source file and offset order)
+# ids - optional set of ticket ids to keep
+def scan_deduped_lines(n, ids = None, db_path = DEDUP_DB):
+    con = sqlite3.connect(db_path)
+    fd = None
+    current = None
+    try:
+        rows = con.execute("SELECT id, source, offset, length FROM tickets "
+                           "ORDER BY source, offset")
+        rows = (row for row in rows if ids is None or row[0] in ids)
+        for batch in batch_records(rows, n):
+            lines = []
+            for _, source, offset, length in batch:
+                if (source != current):
+                    if (fd is not None):
+                        os.close(fd)
+                    fd = os.open(source, os.O_RDONLY | 
+                                 getattr(os, "O_BINARY", 0))
+                    current = source
+                lines.append(read_range(fd, offset, length))
+            yield lines
+    finally:
+        if (fd is not None):
+            os.close(fd)
+        con.close()
+
+# load_json_stream over several exports with every ticket only once, in its
+# newest version
+# filepaths - uncompressed json exports
+# ids, fields, comment_fields - see load_json_stream
+def load_deduped_stream(filepaths, n, ids = None, fields = None, 
+                        comment_fields = None, db_path = DEDUP_DB):
+    build_dedup_index(filepaths, db_path)
+    for lines in scan_deduped_lines(n, ids, db_path):
+        yield parse_json_lines(lines, fields, comment_fields)
 
 ########################
 #### Test functions ####
@@ -185,8 +1638,327 @@ def all_dicts(lst):
         assert(isinstance(lst[i], dict))
     print("passed!")
 
+def test_scan_line_id():
+    print("Testing function 'scan_line_id'...", end = "")
+    assert(scan_line_id(b'{"url": "x", "id": 12, "via": {"id": 3}}') == 12)
+    assert(scan_line_id(b'{"via": {"id": 3}, "id": 12}') == 12)
+    assert(scan_line_id(b'{"subject": "{", "id": 12}') == 12)
+    assert(scan_line_id(b'{"url": "x"}') == None)
+    print("passed!")
+
+# random json-ish lines of up to 40 bytes: some blank, some ending in \r
+def get_test_lines(rng, n):
+    lines = []
+    for i in range(n):
+        line = b'{"id": %d, "s": "%s"}' % (i, b"x" * int(rng.integers(0, 20)))
+        kind = rng.integers(0, 5)
+        if (kind == 0):
+            line = b""
+        elif (kind == 1):
+            line = b"  "
+        elif (kind == 2):
+            line += b"\r"
+        lines.append(line)
+    return lines
+
+def test_iter_line_blocks():
+    print("Testing function 'iter_line_blocks'...", end = "")
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        filepath = os.path.join(tmp, "export.json")
+        for trial in range(20):
+            lines = get_test_lines(rng, int(rng.integers(0, 30)))
+            content = b"\n".join(lines) + (b"\n" if trial % 2 else b"")
+            expected = split_lines(content)
+            with open(filepath, "wb") as file:
+                file.write(content)
+            with gzip.open(filepath + ".gz", "wb") as file:
+                file.write(content)
+            # blocks smaller than one line exercise the long line path
+            for block_size in [1, 7, 64, SCAN_BLOCK_SIZE]:
+                for path in [filepath, filepath + ".gz"]:
+                    blocks = iter_line_blocks(path, block_size = block_size)
+                    assert(sum(blocks, []) == expected)
+    print("passed!")
+
+def test_split_byte_ranges():
+    print("Testing function 'split_byte_ranges'...", end = "")
+    rng = np.random.default_rng(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        filepath = os.path.join(tmp, "export.json")
+        for trial in range(20):
+            lines = get_test_lines(rng, int(rng.integers(0, 30)))
+            content = b"\n".join(lines) + (b"\n" if trial % 2 else b"")
+            with open(filepath, "wb") as file:
+                file.write(content)
+            for shards in [1, 2, 3, 8, 100]:
+                ranges = split_byte_ranges(filepath, shards)
+                # in order, back to back, and covering the whole file
+                bounds = [b for r in ranges for b in r]
+                assert(bounds == sorted(bounds))
+                assert(all(r[0] < r[1] for r in ranges))
+                assert(all(a[1] == b[0] for a, b in zip(ranges, ranges[1:])))
+                assert(bounds[:1] + bounds[-1:] == 
+                       ([0, len(content)] if content else []))
+                # every line in exactly one range
+                found = [line for start, end in ranges 
+                         for line in sum(iter_line_blocks(filepath, start, end,
+                                                          block_size = 5), [])]
+                assert(found == split_lines(content))
+    print("passed!")
+
+def test_scan_line_updated_at():
+    print("Testing function 'scan_line_updated_at'...", end = "")
+    line = b'{"id": 1, "updated_at": "2020-02-01T00:00:00Z", "x": {}}'
+    assert(scan_line_updated_at(line) == "2020-02-01T00:00:00Z")
+    line = b'{"rating": {"updated_at": "a"}, "updated_at": "b"}'
+    assert(scan_line_updated_at(line) == "b")
+    # zendesk order: nested via (with brackets in a string) before the key
+    line = (b'{"id": 2, "via": {"source": {"from": {"id": 9}}}, "subject": ' 
+            b'"a \\" { [", "tags": ["x"], "updated_at": "c", "c": [{}]}')
+    assert(match_top_level(UPDATED_AT_PATTERN, line).group(1) == b"c")
+    line = b'{"x": "\\"updated_at\\": \\"d\\"", "y": {"updated_at": "e"}}'
+    assert(match_top_level(UPDATED_AT_PATTERN, line) is None)
+    assert(scan_line_updated_at(line) is None)
+    print("passed!")
+
+def test_batch_records():
+    print("Testing function 'batch_records'...", end = "")
+    assert(list(batch_records(range(5), 2)) == [[0, 1], [2, 3], [4]])
+    assert(list(batch_records([], 2)) == [])
+    evens = filter_records(range(6), lambda x: x % 2 == 0)
+    assert(list(map_records(evens, str)) == ["0", "2", "4"])
+    print("passed!")
+
+def test_probe_lookup():
+    print("Testing function 'probe_lookup'...", end = "")
+    lookup = pd.DataFrame({"id": [5, 1, 3], "customer": ["a", "b", "a"]})
+    chunk = pd.DataFrame({"id": [1, 2, 3, 6], "comments": [[], [], [], []]})
+    data = probe_lookup(chunk, build_lookup_index(lookup))
+    assert(list(data.id) == [1, 3] and list(data.customer) == ["b", "a"])
+    data = probe_lookup(chunk, build_lookup_index(lookup, "a"))
+    assert(list(data.id) == [3] and list(data.customer) == ["a"])
+    assert(len(probe_lookup(chunk, build_lookup_index(lookup, "c"))) == 0)
+    # an index of every customer, filtered to one per chunk
+    lookup = pd.DataFrame({"id": [5, 1, 3], "customer": ["a", "b", "b, a"]})
+    data = singleCustomerReportChunk(chunk, build_lookup_index(lookup), "a")
+    assert(list(data.id) == [3])
+    print("passed!")
+
+def test_customer_index():
+    print("Testing function 'build_customer_index'...", end = "")
+    lookup = pd.DataFrame({"id": [4, 1, 3, 2], 
+                           "customer": ["a, b", "b", None, "a"]})
+    index = build_customer_index(lookup)
+    assert(list(index["customers"]) == ["a", "a, b", "b"])
+    assert(list(customer_members(index, "a")) == [2, 4])
+    assert(list(customer_members(index, "b")) == [1, 4])
+    assert(list(customer_members(index, "a, b")) == [4])
+    assert(len(customer_members(index, "c")) == 0)
+    # "Inc." isn't a customer, so "Acme, Inc." is one name and not a list
+    named = build_customer_index(pd.DataFrame({
+        "id": [1, 2, 3], "customer": ["Acme, Inc.", "Acme", "Acme, Inc. "]}))
+    assert(list(customer_members(named, "Acme, Inc.")) == [1, 3])
+    assert(list(customer_members(named, "Acme")) == [2])
+    assert(list(route_customers(pd.DataFrame({"id": [1, 2]}), named).customer)
+           == ["Acme, Inc.", "Acme"])
+    data = pd.DataFrame({"customer": ["Acme, Inc.", "Acme", "a, b", None]})
+    known = get_known_customers(["Acme, Inc.", "Acme", "a", "b", "a, b"])
+    assert(list(filter_customer(data, "Acme", known).customer) == ["Acme"])
+    assert(list(filter_customer(data, "b", known).customer) == ["a, b"])
+    chunk = pd.DataFrame({"id": [4, 3, 1]})
+    routed = route_customers(chunk, index)
+    assert(list(routed.id) == [4, 4, 1])
+    assert(list(routed.customer) == ["a", "b", "b"])
+    assert(list(route_customers(chunk, index, ["a"]).id) == [4])
+    # "aa" isn't a customer; it must not pick up "b", its sorted neighbour
+    assert(list(route_customers(chunk, index, ["aa"]).id) == [])
+    assert(list(route_customers(chunk, index, ["b", "z"]).id) == [4, 1])
+    print("passed!")
+
+def test_trim_comments():
+    print("Testing function 'trim_comments'...", end = "")
+    data = pd.DataFrame({"id": [1, 2, 3], "comments": [
+        [{"body": "a"}, {"body": "b"}], [], [{"body": "c"}]]})
+    offsets, values = get_comment_values(data.comments)
+    assert(list(offsets) == [0, 2, 2, 3] and values == ["a", "b", "c"])
+    trimmed = trim_comments(data)
+    assert(list(trimmed.comments) == [["a", "b"], [], ["c"]])
+    assert(data.comments[0] == [{"body": "a"}, {"body": "b"}])
+    print("passed!")
+
+def test_flatten_comments():
+    print("Testing function 'flatten_comments'...", end = "")
+    data = pd.DataFrame({"id": [7, 8, 9], 
+                         "comments": [["a", "b"], [], ["c"]]}, index = [2, 0, 1])
+    flattened = flatten_comments(data)
+    assert(list(flattened.id) == [7, 7, 9])
+    assert(list(flattened.comment_index) == [0, 1, 0])
+    assert(list(flattened.comments) == ["a", "b", "c"])
+    assert(len(flatten_comments(data.iloc[0:0])) == 0)
+    print("passed!")
+
+def test_comment_table():
+    print("Testing function 'get_comment_table'...", end = "")
+    data = pd.DataFrame({"id": [7, 8], "comments": [
+        [{"author_id": 1, "public": True, "created_at": "2020-01-02T03:04Z"},
+         {"author_id": 2, "public": False}], 
+        [{"author_id": 3, "public": True, "created_at": "2021-01-01T00:00Z"}]]})
+    table = get_comment_table(data, ["author_id", "public", "created_at"])
+    assert(list(table.id) == [7, 7, 8])
+    assert(list(table.comment_index) == [0, 1, 0])
+    assert(str(table.author_id.dtype) == "Int64")
+    assert(str(table.public.dtype) == "boolean")
+    assert(str(table.created_at.dtype).startswith("datetime64"))
+    assert(table.created_at[0] == pd.Timestamp("2020-01-02 03:04", tz = "UTC"))
+    assert(pd.isna(table.created_at[1]))
+    print("passed!")
+
+def test_partition_writers():
+    print("Testing function 'get_partition_path'...", end = "")
+    with tempfile.TemporaryDirectory() as tmp:
+        writers = open_partition_writers(tmp, max_open = 1, buffer_rows = 1)
+        for customer in ["A/B", "A_B", "a_b", "A/B"]:
+            write_partition(writers, (customer, "comments"), 
+                            pd.DataFrame({"customer": [customer]}))
+        close_partition_writers(writers)
+        assert(sorted(os.listdir(tmp)) == ["A_B", "A_B_2", "a_b_3"])
+        data = pd.read_csv(os.path.join(tmp, "A_B", "comments.csv"))
+        assert(list(data.customer) == ["A/B", "A/B"])
+        data = pd.read_csv(os.path.join(tmp, "A_B_2", "comments.csv"))
+        assert(list(data.customer) == ["A_B"])
+    print("passed!")
+
+def test_merge_join_chunk():
+    print("Testing function 'merge_join_chunk'...", end = "")
+    index = build_lookup_index(pd.DataFrame({"id": [2, 4, 6], 
+                                             "customer": ["a", "b", "a"]}))
+    state = new_merge_state()
+    data = merge_join_chunk(pd.DataFrame({"id": [1, 2, 3, 4]}), index, state)
+    assert(list(data.id) == [2, 4] and list(data.customer) == ["a", "b"])
+    assert(state["cursor"] == 1)
+    data = merge_join_chunk(pd.DataFrame({"id": [6, 7]}), index, state)
+    assert(list(data.id) == [6] and state["cursor"] == 3)
+    # past the end of the index; a late ticket out of order is still found
+    assert(len(merge_join_chunk(pd.DataFrame({"id": [8]}), index, state)) == 0)
+    data = merge_join_chunk(pd.DataFrame({"id": [9, 4]}), index, state)
+    assert(list(data.id) == [4] and not state["sorted"])
+    state = new_merge_state() # out of order chunks fall back to probing
+    merge_join_chunk(pd.DataFrame({"id": [4]}), index, state)
+    data = merge_join_chunk(pd.DataFrame({"id": [2]}), index, state)
+    assert(list(data.id) == [2] and not state["sorted"])
+    # an id repeated across a chunk boundary is found in both chunks
+    index = build_lookup_index(pd.DataFrame({"id": [2, 4], 
+                                             "customer": ["a", "a"]}))
+    state = new_merge_state()
+    assert(list(merge_join_chunk(pd.DataFrame({"id": [1, 2]}), index, 
+                                 state).id) == [2])
+    assert(list(merge_join_chunk(pd.DataFrame({"id": [2, 3]}), index, 
+                                 state).id) == [2])
+    assert(state["sorted"])
+    print("passed!")
+
+# the merge join must read the whole export: to find tickets appended out of
+# order after the lookup is used up, and to finish writing the parse cache
+def test_report_stream():
+    global CACHE_DIR
+    print("Testing function 'singleCustomerReportStream'...", end = "")
+    cache_dir = CACHE_DIR
+    with tempfile.TemporaryDirectory() as tmp:
+        CACHE_DIR = os.path.join(tmp, "cache")
+        filepath = os.path.join(tmp, "export.json")
+        with open(filepath, "w", encoding = "utf8") as file:
+            for i in [1, 2, 4, 5, 6, 3]:
+                ticket = {"id": i, "comments": [{"body": str(i)}]}
+                file.write(json.dumps(ticket) + "\n")
+        index = build_lookup_index(pd.DataFrame({"id": [2, 3, 4], 
+                                                 "customer": ["a"] * 3}))
+        try:
+            for cache in [False, True, True]: # the second pass reads it back
+                data = pd.concat(singleCustomerReportStream(
+                    filepath, 0, None, index, "", 2, cache = cache))
+                assert(list(data.id) == [2, 4, 3])
+                assert(list(data.comments) == [["2"], ["4"], ["3"]])
+            if (pa is not None):
+                key = get_cache_key(filepath, REPORT_FIELDS, ["body"])
+                assert(get_cache_entry(key) is not None)
+        finally:
+            CACHE_DIR = cache_dir
+    print("passed!")
+
+def test_iter_pool_results():
+    print("Testing function 'iter_pool_results'...", end = "")
+    with ThreadPoolExecutor(max_workers = 2) as pool: # any executor will do
+        args = ((x,) for x in [4, -1, 9, -16])
+        assert(list(iter_pool_results(pool, abs, args, 2)) == [4, 1, 9, 16])
+    print("passed!")
+
+def test_json_cache():
+    global CACHE_DIR
+    print("Testing function 'write_json_cache'...", end = "")
+    cache_dir = CACHE_DIR
+    with tempfile.TemporaryDirectory() as tmp:
+        CACHE_DIR = os.path.join(tmp, "cache")
+        filepath = os.path.join(tmp, "export.json")
+        with open(filepath, "w", encoding = "utf8") as file:
+            for i in range(1, 6):
+                ticket = {"id": i, "subject": f"s{i}", "via": {"id": i}, 
+                          "comments": [{"body": str(i)}] * i}
+                file.write(json.dumps(ticket) + "\n")
+        try:
+            plain = pd.concat(load_json_stream(filepath, 2))
+            for cache in [True, True]: # writes the cache, then reads it
+                data = pd.concat(load_json_stream(filepath, 2, cache = cache))
+                assert(data.reset_index(drop = True).equals(
+                    plain.reset_index(drop = True)))
+            if (pa is not None):
+                key = get_cache_key(filepath, None, None)
+                assert(get_cache_entry(key) is not None)
+            data = pd.concat(load_json_stream(filepath, 2, ids = {2, 5}, 
+                                              cache = True))
+            assert(list(data.id) == [2, 5])
+            assert(list(data.via) == [{"id": 2}, {"id": 5}])
+        finally:
+            CACHE_DIR = cache_dir
+    print("passed!")
+
+def test_line_index():
+    print("Testing function 'get_tickets'...", end = "")
+    with tempfile.TemporaryDirectory() as tmp:
+        filepath = os.path.join(tmp, "export.json")
+        lines = [b'{"id": 3, "via": {"id": 9}}', b'{"id": 1}\r', b"", 
+                 b'{"id": 2, "s": "x"}']
+        with open(filepath, "wb") as file:
+            file.write(b"\n".join(lines)) # no trailing newline
+        stat = os.stat(filepath)
+        assert(list(get_tickets([2, 3, 7], filepath).id) == [2, 3])
+        assert(list(load_line_index(filepath)["id"]) == [1, 2, 3])
+        # an older copy swapped in with the same mtime still rebuilds
+        with open(filepath, "wb") as file:
+            file.write(b'{"id": 2, "s": "older copy"}\n{"id": 3}\n')
+        os.utime(filepath, ns = (stat.st_atime_ns, stat.st_mtime_ns))
+        data = get_tickets([2, 3], filepath)
+        assert(list(data.id) == [2, 3] and data.s[0] == "older copy")
+    print("passed!")
+
 def test_all():
     test_which()
+    test_scan_line_id()
+    test_iter_line_blocks()
+    test_split_byte_ranges()
+    test_scan_line_updated_at()
+    test_batch_records()
+    test_probe_lookup()
+    test_customer_index()
+    test_trim_comments()
+    test_flatten_comments()
+    test_comment_table()
+    test_partition_writers()
+    test_merge_join_chunk()
+    test_report_stream()
+    test_iter_pool_results()
+    test_json_cache()
+    test_line_index()
 
 #############################
 #### Operation Functions ####
@@ -197,48 +1969,461 @@ def test_all():
 # reads in merged data (requires both json and csv) for a single customer
 # trims comments, exports in threaded format, flattens and exports unthreaded
 # assumes that data does not need to be read in chunks
-def singleCustomerReport(customer):
-    data = load_merged_data(customer = customer)
-    trim_comments(data)
+def singleCustomerReport(customer, cache = False):
+    data = load_merged_data(customer = customer, fields = REPORT_FIELDS,
+                            comment_fields = ["body"], cache = cache)
+    data = trim_comments(data)
     export_comments(data)
     data = flatten_comments(data)
-    export_comments(data, "flattened_emails")
+    export_comments(data, "flattened_emails", fields = FLATTENED_FIELDS)
 
 # for use when the json file is massive and requires a chunksize parameter
 # returns the data merged and filtered by customer
 # chunk - chunk of the large json file as read by a reader
-# lookup - csv file with id and customer information
+# lookup - lookup index (see build_lookup_index), or a df with id and 
+# customer information (slower, as it is indexed again for every chunk)
 # customer - string value of the custumer we want to filter for
-def singleCustomerReportChunk(chunk, lookup, customer = ""):
-    data = chunk.merge(lookup, how = "inner", on = "id")
-    if (customer != ""):
-        data = data[data["customer"] == customer]
+# state - optional merge state (see merge_join_chunk) for a pass over an
+# export that is likely ordered by id
+def singleCustomerReportChunk(chunk, lookup, customer = "", state = None):
+    if (isinstance(lookup, pd.DataFrame)):
+        lookup = build_lookup_index(lookup, customer)
+    if (state is not None):
+        data = merge_join_chunk(chunk, lookup, state)
+    else:
+        data = probe_lookup(chunk, lookup)
+    if (customer != "" and lookup["customer"] != customer):
+        data = filter_customer(data, customer, 
+                               get_known_customers(lookup["customers"]))
     return(data)
 
-def singleCustomerReportChunks(customer, chunksize):
+# reads one byte range of the json file and yields it chunk by chunk, 
+# merged, filtered and trimmed
+# start, end - byte range of the json file, see split_byte_ranges
+# ids - set of ticket ids worth decoding, or None to decode every line
+# cache - use the parse cache, see load_json_stream (whole file only)
+# chunk_bytes - if given, chunks are sized to roughly this many bytes in 
+# memory instead of chunksize rows, see load_json_stream_budgeted
+# stats - optional dict for the chunk sizes chosen with chunk_bytes
+def singleCustomerReportStream(filepath, start, end, lookup, customer, 
+                               chunksize, ids = None, cache = False,
+                               chunk_bytes = None, stats = None):
+    if (chunk_bytes is not None):
+        chunks = load_json_stream_budgeted(filepath, chunk_bytes, start, end,
+                                           ids, REPORT_FIELDS, ["body"], 
+                                           stats)
+    else:
+        chunks = load_json_stream(filepath, chunksize, start, end, ids,
+                                  fields = REPORT_FIELDS, 
+                                  comment_fields = ["body"], cache = cache)
+    # merge join while the export turns out to be ordered by id
+    state = None if isinstance(lookup, pd.DataFrame) else new_merge_state()
+    for chunk in chunks:
+        yield trim_report_chunk(chunk, lookup, customer, state)
+
+# singleCustomerReportChunk followed by trim_comments
+def trim_report_chunk(chunk, lookup, customer, state = None):
+    data = singleCustomerReportChunk(chunk, lookup, customer, state)
+    return trim_comments(data)
+
+# singleCustomerReportStream collected into one df
+# this is the unit of work handed to each process in the parallel mode
+def singleCustomerReportShard(filepath, start, end, lookup, customer, 
+                              chunksize, ids = None, cache = False,
+                              chunk_bytes = None, stats = None):
+    tickets = list(singleCustomerReportStream(filepath, start, end, lookup,
+                                              customer, chunksize, ids, cache,
+                                              chunk_bytes, stats))
+    if (len(tickets) == 0): # no line of this range survived the id filter
+        return pd.DataFrame(columns = ["id", "comments", "customer"])
+    return pd.concat(tickets, ignore_index = True)
+
+# singleCustomerReportStream over a whole file that survives being killed:
+# every chunk's result is saved to SPILL_DIR and recorded in 
+# SPILL_DIR/checkpoint.json. A rerun with the same inputs, customer and 
+# chunksize skips the chunks that are already done without decoding them.
+# Once every chunk is done, the saved chunks are yielded in file order. 
+# The spill directory is emptied by the caller once the outputs are written.
+def singleCustomerReportCheckpointed(filepath, lookup, customer, chunksize,
+                                     ids = None):
+    os.makedirs(SPILL_DIR, exist_ok = True)
+    csvpath = get_filepath_by_type("data/parser_input", "csv")
+    run = hashlib.sha256(json.dumps([
+        get_file_fingerprint(filepath), get_file_fingerprint(csvpath),
+        customer, chunksize]).encode("utf8")).hexdigest()
+    target = os.path.join(SPILL_DIR, "checkpoint.json")
+    manifest = {"run": run, "done": []}
+    if (os.path.exists(target)):
+        with open(target, "r", encoding = "utf8") as file:
+            manifest = json.load(file)
+    if (manifest["run"] != run): # leftovers of a different run
+        clear_dir(SPILL_DIR)
+        manifest = {"run": run, "done": []}
+    done = set(manifest["done"])
+    chunks = scan_json_lines(filepath, chunksize, ids = ids)
+    for i, lines in enumerate(chunks):
+        if (i in done):
+            continue
+        chunk = parse_json_lines(lines, REPORT_FIELDS, ["body"])
+        data = trim_report_chunk(chunk, lookup, customer)
+        data.to_pickle(os.path.join(SPILL_DIR, f"chunk{i:08d}.pkl"))
+        manifest["done"].append(i)
+        with open(target + ".tmp", "w", encoding = "utf8") as file:
+            json.dump(manifest, file)
+        os.replace(target + ".tmp", target)
+    spills = sorted(f for f in os.listdir(SPILL_DIR) if f.endswith(".pkl"))
+    for f in spills:
+        yield pd.read_pickle(os.path.join(SPILL_DIR, f))
+
+# workers - number of processes to use. With more than one worker the json 
+# file is cut into byte ranges of about RANGE_BYTES that are processed in a
+# process pool; results are written in file order, so the output matches the
+# serial run.
+# cache - use the parse cache. A cached file is always read serially, since 
+# reading the cache is faster than parsing in parallel; an uncached file 
+# read in parallel is not written to the cache.
+# checkpoint - run serially through singleCustomerReportCheckpointed, so an
+# interrupted run can be restarted where it stopped
+# chunk_bytes - size chunks by memory instead of rows, see 
+# load_json_stream_budgeted (the cache and checkpoints are not used then)
+# stats - optional dict that receives the chosen chunk sizes of a serial run
+# Each chunk (or range) is trimmed, flattened and appended to the outputs as
+# soon as it arrives (see export_report), so memory use doesn't grow with 
+# the number of tickets of the customer: a serial run holds one chunk, a 
+# parallel run the results of at most two ranges per worker.
+def singleCustomerReportChunks(customer, chunksize, workers = 1, 
+                               cache = False, checkpoint = False,
+                               chunk_bytes = None, stats = None):
     dirpath = get_filepath_by_type("data/parser_input", "json")
-    stream = load_json_stream(dirpath, chunksize)
-    lookup = load_first_csv()
-    lookup = lookup.rename(columns = {"Id": "id", "Customer [list]": "customer"})
-    lookup = get_columns(lookup, ["id", "customer"])
-    tickets = []
-    for chunk in stream:
-        tickets.append(singleCustomerReportChunk(chunk, lookup, customer))
-    # flatten tickets
-    tickets = pd.concat(tickets)
-    trim_comments(tickets)
-    export_comments(tickets)
-    tickets = flatten_comments(tickets)
-    export_comments(tickets, "flattened_emails")
+    lookup = load_first_lookup()
+    # tickets of other customers are skipped before they are decoded
+    lookup, ids = get_report_lookup(lookup, customer)
+    cached = cache and get_cache_entry(
+        get_cache_key(dirpath, REPORT_FIELDS, ["body"])) is not None
+    if (checkpoint and chunk_bytes is None):
+        export_report(singleCustomerReportCheckpointed(dirpath, lookup, 
+                                                       customer, chunksize,
+                                                       ids))
+        clear_dir(SPILL_DIR) # the checkpoint is done
+    # compressed files can't be cut into byte ranges, so they run serially
+    elif (workers > 1 and not is_compressed(dirpath) and not cached):
+        # a few ranges per worker keeps the pool busy if one range is slow
+        size = os.path.getsize(dirpath)
+        ranges = split_byte_ranges(dirpath, max(workers * 4, 
+                                                -(-size // RANGE_BYTES)))
+        args = ((dirpath, start, end, lookup, customer, chunksize, ids, 
+                 False, chunk_bytes) for start, end in ranges)
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            # the ranges come back in file order, each written as it arrives
+            export_report(iter_pool_results(pool, singleCustomerReportShard,
+                                            args, workers * 2))
+    else:
+        export_report(singleCustomerReportStream(dirpath, 0, None, lookup, 
+                                                 customer, chunksize, ids, 
+                                                 cache, chunk_bytes, stats))
+
+
+# runs the report of one json export and writes its outputs tagged with the
+# export's name; the unit of work of allExportsReport
+def singleExportReport(filepath, lookup, customer, chunksize, ids = None):
+    export_report(singleCustomerReportStream(filepath, 0, None, lookup, 
+                                             customer, chunksize, ids),
+                  tag = "_" + get_file_stem(filepath))
+
+# singleCustomerReportChunks for every json export in data/parser_input at
+# once. The lookup csvs are unioned into one lookup up front; each export is
+# then reported by its own worker process and gets its own outputs, e.g. 
+# comments_<export name>.csv
+# workers - number of exports processed at the same time
+def allExportsReport(customer, chunksize, workers = 1):
+    filepaths = get_filepaths_by_type("data/parser_input", "json")
+    lookup = load_all_csvs()
+    lookup, ids = get_report_lookup(lookup, customer)
+    if (workers > 1 and len(filepaths) > 1):
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            # list() surfaces the first exception raised by a worker
+            list(pool.map(singleExportReport, filepaths, 
+                          itertools.repeat(lookup), 
+                          itertools.repeat(customer),
+                          itertools.repeat(chunksize), 
+                          itertools.repeat(ids)))
+    else:
+        for filepath in filepaths:
+            singleExportReport(filepath, lookup, customer, chunksize, ids)
+
+# singleCustomerReportChunks over every json export in data/parser_input 
+# combined, reporting each ticket once in its newest version (see 
+# Deduplication). Writes a single comments and flattened_emails output.
+def dedupedExportsReport(customer, chunksize):
+    filepaths = get_filepaths_by_type("data/parser_input", "json")
+    lookup = load_all_csvs()
+    lookup, ids = get_report_lookup(lookup, customer)
+    chunks = load_deduped_stream(filepaths, chunksize, ids, REPORT_FIELDS,
+                                 ["body"])
+    export_report(trim_report_chunk(chunk, lookup, customer) 
+                  for chunk in chunks)
+
+# singleCustomerReportChunks for lookups larger than memory: every lookup 
+# csv in data/parser_input and the first json are hash partitioned by id 
+# into buckets and joined bucket by bucket (see Partition Join). Peak memory
+# is about one bucket of the lookup plus one chunk. The outputs are grouped 
+# by bucket instead of following the order of the json.
+# buckets - number of buckets; more buckets mean smaller ones
+def partitionedJoinReport(customer, chunksize, buckets = 64):
+    filepath = get_filepath_by_type("data/parser_input", "json")
+    shutil.rmtree(JOIN_DIR, ignore_errors = True)
+    os.makedirs(JOIN_DIR)
+    try:
+        kept = partition_lookups(get_filepaths_by_type("data/parser_input", 
+                                                       "csv"), 
+                                 buckets, JOIN_DIR, customer)
+        if (customer != "" and kept == 0):
+            warnings.warn(f"customer {customer!r} is not in the lookup")
+        partition_tickets(filepath, buckets, JOIN_DIR)
+        chunks = iter_bucket_joins(buckets, chunksize, JOIN_DIR, 
+                                   REPORT_FIELDS, ["body"])
+        export_report(map_records(chunks, trim_comments))
+    finally:
+        shutil.rmtree(JOIN_DIR, ignore_errors = True)
+
+# singleCustomerReportChunks for many customers in a single pass over the 
+# json: every ticket is routed to its customer's partition, written to
+# data/parser_output/<customer>/comments.csv and flattened_emails.csv 
+# through bounded partition writers (see Partition Writers). A ticket with 
+# several customers goes to each of their partitions.
+# customers - list of customer names, or "all" for every customer in the csv
+def multiCustomerReport(customers, chunksize, max_open = 64, 
+                        buffer_rows = 100000):
+    filepath = get_filepath_by_type("data/parser_input", "json")
+    lookup = load_first_lookup()
+    index = build_customer_index(lookup)
+    if (customers == "all"): # every customer a ticket can be routed to
+        customers = list(index["customers"][np.unique(index["pair_customers"])])
+    for customer in customers:
+        check_customer(index, customer)
+    ids = set(itertools.chain.from_iterable(
+        customer_members(index, customer).tolist() for customer in customers))
+    writers = open_partition_writers(PARTITION_DIR, max_open, buffer_rows)
+    rows = collections.Counter()
+    emails = collections.Counter()
+    try:
+        for chunk in load_json_stream(filepath, chunksize, ids = ids,
+                                      fields = REPORT_FIELDS, 
+                                      comment_fields = ["body"]):
+            # trim before routing, so a ticket with several customers has its
+            # comments trimmed once rather than once per row
+            chunk = trim_comments(chunk)
+            data = route_customers(chunk, index, customers)
+            for customer, group in data.groupby("customer", sort = False):
+                # row numbers continue per customer, as in export_report
+                group = group.set_axis(range(rows[customer], 
+                                             rows[customer] + len(group)))
+                flattened = flatten_comments(group)
+                flattened = flattened.set_axis(
+                    range(emails[customer], emails[customer] + len(flattened)))
+                rows[customer] += len(group)
+                emails[customer] += len(flattened)
+                write_partition(writers, (customer, "comments"), 
+                                get_columns(group, REPORT_FIELDS))
+                write_partition(writers, (customer, "flattened_emails"), 
+                                get_columns(flattened, FLATTENED_FIELDS))
+    finally:
+        close_partition_writers(writers)
 
+# singleCustomerReportChunks for exports that grow between runs: only the
+# lines added since the last run (see Ingest State) are processed, and their
+# rows are appended to the existing comments and flattened_emails outputs. 
+# Tickets that were already exported are not updated. Row numbers continue 
+# from the previous run, as in export_report. If the outputs were changed 
+# since (removed, or rewritten by another run or customer), the report starts
+# over.
+def incrementalCustomerReport(customer, chunksize):
+    filepath = get_filepath_by_type("data/parser_input", "json")
+    outputs = ["data/parser_output/comments.csv",
+               "data/parser_output/flattened_emails.csv"]
+    state = read_ingest_state()
+    key = f"{os.path.abspath(filepath)}|{customer}"
+    entry = state.get(key)
+    if (entry is not None and entry["outputs"] != get_output_stamps(outputs)):
+        entry = None
+    start, max_id = get_resume_point(filepath, entry)
+    # compressed files can't be cut at a byte offset, see iter_line_blocks
+    end = None if is_compressed(filepath) else os.path.getsize(filepath)
+    lookup, ids = get_report_lookup(load_first_lookup(), customer)
+    ids = set(lookup["ids"].tolist()) if ids is None else ids
+    if (max_id is not None):
+        ids = {ticket_id for ticket_id in ids if ticket_id > max_id}
+    append = entry is not None
+    counts = {"rows": entry["rows"] if append else 0, 
+              "emails": entry["emails"] if append else 0}
+    marks = {"max_id": entry["max_id"] if append else None}
+    tickets = singleCustomerReportStream(filepath, start, end, lookup, 
+                                         customer, chunksize, ids)
+    export_report(track_max_id(tickets, marks), append = append, 
+                  counts = counts)
+    state[key] = {"offset": end, "max_id": marks["max_id"],
+                  "head": None if end is None else get_head_hash(filepath, 
+                                                                 end),
+                  "outputs": get_output_stamps(outputs),
+                  "rows": counts["rows"], "emails": counts["emails"]}
+    write_ingest_state(state)
+
+# pure python version of singleCustomerReportChunks for exports that are too
+# big for pandas: tickets stream through generator stages and are written
+# batch by batch to comments.json and flattened_emails.json, so memory use
+# does not grow with the size of the export
+def singleCustomerReportRecords(customer, chunksize):
+    filepath = get_filepath_by_type("data/parser_input", "json")
+    lookup = load_first_lookup()
+    # tickets missing from the lookup are dropped, as in the merge
+    if (customer != ""):
+        ids = get_customer_ids(lookup, customer)
+    else:
+        ids = set(lookup.id.tolist())
+    tickets = iter_tickets(filepath, ids, REPORT_FIELDS, ["body"])
+    tickets = filter_records(tickets, lambda ticket: ticket["id"] in ids)
+    tickets = map_records(tickets, trim_record_comments)
+    with open("data/parser_output/comments.json", "w", 
+              encoding = "utf8") as threaded, \
+         open("data/parser_output/flattened_emails.json", "w", 
+              encoding = "utf8") as flattened:
+        for batch in batch_records(tickets, chunksize):
+            threaded.write("".join(json_dumps(ticket) + "\n" 
+                                   for ticket in batch))
+            emails = itertools.chain.from_iterable(map(flatten_record, batch))
+            flattened.write("".join(json_dumps(email) + "\n" 
+                                    for email in emails))
+
+# writes data/parser_output/comment_table.csv: one row per comment of the 
+# customer's tickets with one column per key in modes, see get_comment_table.
+# Every key is pulled out of the same parse, so getting e.g. the authors and
+# dates as well as the bodies takes a single run.
+# modes - list of comment keys
+def commentTableReport(customer, chunksize, modes):
+    filepath = get_filepath_by_type("data/parser_input", "json")
+    lookup = load_first_lookup()
+    lookup, ids = get_report_lookup(lookup, customer)
+    state = new_merge_state()
+    first = True
+    rows = 0
+    for chunk in load_json_stream(filepath, chunksize, ids = ids,
+                                  fields = REPORT_FIELDS, 
+                                  comment_fields = modes):
+        data = singleCustomerReportChunk(chunk, lookup, customer, state)
+        table = get_comment_table(data, modes)
+        table = table.set_axis(range(rows, rows + len(table)))
+        export(table, "comment_table", append = not first)
+        rows += len(table)
+        first = False
+    if (first):
+        empty = pd.DataFrame(columns = REPORT_FIELDS)
+        export(get_comment_table(empty, modes), "comment_table")
+
+# times every installed json backend on the first n lines of the first json
+# in the input directory and prints decode and encode throughput. Each 
+# measurement is repeated and the best time kept (the first round also warms
+# up caches), with the garbage collector paused so its passes over the 
+# decoded records don't land on whichever backend happens to trigger them.
+# repeats - number of times each backend decodes and encodes the lines
+def jsonBackendBenchmark(n = 10000, repeats = 5):
+    filepath = get_filepath_by_type("data/parser_input", "json")
+    lines = next(scan_json_lines(filepath, n), [])
+    size = sum(len(line) for line in lines) / 1e6
+    print(f"{len(lines)} lines, {size:.1f} MB from {filepath}, " + 
+          f"best of {repeats}")
+    for name, (loads, dumps) in get_json_backends().items():
+        decode = encode = float("inf")
+        for _ in range(repeats):
+            with paused_gc():
+                start = time.perf_counter()
+                records = [loads(line) for line in lines]
+                decode = min(decode, time.perf_counter() - start)
+                start = time.perf_counter()
+                for record in records:
+                    dumps(record)
+                encode = min(encode, time.perf_counter() - start)
+            del records
+            gc.collect()
+        print(f"{name:>8}: decode {size / decode:8.1f} MB/s, " + 
+              f"encode {size / encode:8.1f} MB/s")
 
 def main():
-    singleCustomerReportChunks(CUSTOMER_OF_INTEREST, CHUNKSIZE)
+    if (COMMENT_MODES is not None):
+        commentTableReport(CUSTOMER_OF_INTEREST, CHUNKSIZE, COMMENT_MODES)
+        return
+    if (CUSTOMERS_OF_INTEREST is not None):
+        multiCustomerReport(CUSTOMERS_OF_INTEREST, CHUNKSIZE)
+        return
+    if (ALL_EXPORTS):
+        allExportsReport(CUSTOMER_OF_INTEREST, CHUNKSIZE, WORKERS)
+        return
+    if (DEDUPE_EXPORTS):
+        dedupedExportsReport(CUSTOMER_OF_INTEREST, CHUNKSIZE)
+        return
+    if (INCREMENTAL):
+        incrementalCustomerReport(CUSTOMER_OF_INTEREST, CHUNKSIZE)
+        return
+    if (JOIN_BUCKETS is not None):
+        partitionedJoinReport(CUSTOMER_OF_INTEREST, CHUNKSIZE, JOIN_BUCKETS)
+        return
+    if (JSON_OUTPUT):
+        singleCustomerReportRecords(CUSTOMER_OF_INTEREST, CHUNKSIZE)
+        return
+    stats = {}
+    singleCustomerReportChunks(CUSTOMER_OF_INTEREST, CHUNKSIZE, WORKERS, 
+                               USE_CACHE, CHECKPOINT, CHUNK_BYTES, stats)
+    if (stats):
+        print(f"{len(stats['rows'])} chunks, rows per chunk: " + 
+              f"min {min(stats['rows'])}, max {max(stats['rows'])}")
 
 #####################
 #### Driver Code ####
 #####################
-test_all()
-CUSTOMER_OF_INTEREST = "US Cellular"
-CHUNKSIZE = 1000
-main()
+# the guard keeps the worker processes of the parallel mode from re-running
+# the driver code when they import this file
+if __name__ == "__main__":
+    test_all()
+    CUSTOMER_OF_INTEREST = "US Cellular"
+    # a list of customers (or "all") reports each of them in one pass into 
+    # data/parser_output/<customer>; None reports CUSTOMER_OF_INTEREST only
+    CUSTOMERS_OF_INTEREST = None
+    CHUNKSIZE = 1000
+    # a list of comment keys, e.g. ["author_id", "created_at", "public", 
+    # "body"], writes comment_table.csv with one column per key instead of 
+    # the usual outputs; None runs the usual report
+    COMMENT_MODES = None
+    # bytes of memory per chunk, e.g. 256 * 1024 ** 2; replaces CHUNKSIZE
+    CHUNK_BYTES = None
+    # number of processes; 1 runs everything in this process
+    WORKERS = 1
+    # report every json in data/parser_input (one set of outputs per json), 
+    # instead of only the first one
+    ALL_EXPORTS = False
+    # report every json in data/parser_input as one export, keeping only the
+    # newest version of tickets that are in several of them
+    DEDUPE_EXPORTS = False
+    # only report the tickets added to the json since the last run and 
+    # append them to the outputs of that run
+    INCREMENTAL = False
+    # for csvs too big to load at once: a number of buckets, e.g. 64, joins 
+    # the csvs and the json bucket by bucket on disk; None loads the csv
+    JOIN_BUCKETS = None
+    # write comments.json and flattened_emails.json without pandas, for 
+    # exports too big for it
+    JSON_OUTPUT = False
+    # keep parsed exports in data/parser_cache for the next run (needs 
+    # pyarrow). Writing the cache parses every ticket, not only the 
+    # customer's, so this only pays off when the same export is reported 
+    # again and again
+    USE_CACHE = False
+    # save each chunk to data/parser_spill so a killed run can pick up again
+    CHECKPOINT = False
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    # "python parser.py benchmark" compares the json backends instead
+    if (command == "benchmark"):
+        jsonBackendBenchmark()
+    # "python parser.py clear_cache" empties data/parser_cache
+    elif (command == "clear_cache"):
+        clear_json_cache()
+    else:
+        main()